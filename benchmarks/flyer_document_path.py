@@ -0,0 +1,202 @@
+"""Scaling benchmark of the fly scan document path.
+
+The Flyer is driven against a stand-in camera and HXNStage which report all
+frames as written the moment the scan starts, so only the document path is
+measured: collect_asset_docs(), collect()/collect_pages(), bp.fly and the
+db.insert subscriber.
+
+Run it inside a simulated session of this profile (it uses the Flyer, the
+simulated devices and the temporary Broker of that session):
+
+    FLYER_SIMULATION=1 ipython --profile=<profile>
+    %run -i benchmarks/flyer_document_path.py --grids 10x10 100x100 1000x1000
+    %run -i benchmarks/flyer_document_path.py --compare
+
+Every run appends one JSON line per grid size to
+benchmarks/results/flyer_document_path.jsonl; --compare prints the two most
+recent runs side by side.
+"""
+import argparse
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+from bluesky import RunEngine
+import bluesky.plans as bp
+import bluesky.preprocessors as bpp
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                       'flyer_document_path.jsonl')
+DEFAULT_GRIDS = ['10x10', '100x100', '300x300', '1000x1000']
+
+
+class BenchHXNStage(SimHXNStage):
+    """Stage which 'writes' every frame instantly, without motion or files."""
+    def _run(self):
+        num_points = int(self.nx.get()) * int(self.ny.get())
+        self.scan_in_progress.put(1)
+        for counter in [self.camera.cam.array_counter, self.camera.hdf5.num_captured]:
+            counter.put(counter.get() + num_points)
+        self.scan_in_progress.put(0)
+
+
+class BenchCamera(SimProsilica):
+    def stage(self):
+        # Keep the file tiny: the frames are never written.
+        self.hdf5.num_capture.put(1)
+        return super().stage()
+
+    def unstage(self):
+        ret = super().unstage()
+        self.hdf5.num_captured.put(0)
+        self.cam.array_counter.put(0)
+        return ret
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(RESULTS), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _make_flyer(nx, ny, page_size, datum_pages):
+    camera = BenchCamera(name='bench_cam')
+    stage = BenchHXNStage(name='bench_stage', camera=camera,
+                          scan_in_progress=scan_in_progress)
+    for sig, value in [(stage.x_start, 0.0), (stage.x_stop, 1.0), (stage.nx, nx),
+                       (stage.y_start, 0.0), (stage.y_stop, 1.0), (stage.ny, ny)]:
+        sig.put(value)
+    return Flyer(camera, stage, page_size=page_size, datum_pages=datum_pages)
+
+
+def _fly_and_wait(flyer):
+    flyer.stage()
+    flyer.kickoff().wait()
+    flyer.complete().wait()
+
+
+def bench_methods(nx, ny, page_size, datum_pages, paged, measure_memory):
+    """Time collect_asset_docs() and collect()/collect_pages() on their own."""
+    flyer = _make_flyer(nx, ny, page_size, datum_pages)
+    _fly_and_wait(flyer)
+    try:
+        if measure_memory:
+            tracemalloc.start()
+        t0 = time.perf_counter()
+        num_asset_docs = sum(1 for _ in flyer.collect_asset_docs())
+        t1 = time.perf_counter()
+        collect = flyer.collect_pages if paged else flyer.collect
+        num_events = sum(1 for _ in collect())
+        t2 = time.perf_counter()
+        peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+        flyer.unstage()
+    return {'collect_asset_docs_s': t1 - t0,
+            'asset_docs': num_asset_docs,
+            'collect_s': t2 - t1,
+            'event_docs': num_events,
+            'peak_memory_bytes': peak}
+
+
+def bench_fly(nx, ny, page_size, datum_pages):
+    """Run bp.fly through a RunEngine with a timed db.insert subscriber."""
+    flyer = _make_flyer(nx, ny, page_size, datum_pages)
+    latencies = []
+    counts = defaultdict(int)
+
+    def timed_insert(name, doc):
+        t0 = time.perf_counter()
+        db.insert(name, doc)
+        latencies.append(time.perf_counter() - t0)
+        counts[name] += 1
+
+    bench_RE = RunEngine({})
+    bench_RE.subscribe(timed_insert)
+    t0 = time.perf_counter()
+    bench_RE(bpp.stage_wrapper(bp.fly([flyer]), [flyer]))
+    wall = time.perf_counter() - t0
+    latencies = np.array(latencies)
+    return {'fly_s': wall,
+            'documents': dict(counts),
+            'documents_per_s': len(latencies) / wall,
+            'insert_total_s': float(latencies.sum()),
+            'insert_mean_s': float(latencies.mean()),
+            'insert_p99_s': float(np.percentile(latencies, 99)),
+            'insert_max_s': float(latencies.max())}
+
+
+def run(grids=DEFAULT_GRIDS, page_size=1000, datum_pages=True, paged=True,
+        measure_memory=True, skip_fly=False, results=RESULTS):
+    run_id = time.strftime('%Y-%m-%dT%H:%M:%S')
+    commit = _git_commit()
+    os.makedirs(os.path.dirname(results), exist_ok=True)
+    for grid in grids:
+        nx, ny = (int(n) for n in grid.split('x'))
+        record = {'run_id': run_id, 'commit': commit, 'grid': grid,
+                  'points': nx * ny, 'page_size': page_size,
+                  'datum_pages': datum_pages, 'paged': paged}
+        record.update(bench_methods(nx, ny, page_size, datum_pages, paged,
+                                    measure_memory=False))
+        if measure_memory:
+            record['peak_memory_bytes'] = bench_methods(
+                nx, ny, page_size, datum_pages, paged,
+                measure_memory=True)['peak_memory_bytes']
+        if not skip_fly:
+            record.update(bench_fly(nx, ny, page_size, datum_pages))
+        print(json.dumps(record))
+        with open(results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def compare(results=RESULTS, keys=('collect_asset_docs_s', 'collect_s', 'fly_s',
+                                   'documents_per_s', 'insert_p99_s',
+                                   'peak_memory_bytes')):
+    """Print the two most recent runs side by side."""
+    runs = defaultdict(dict)
+    with open(results) as f:
+        for line in f:
+            record = json.loads(line)
+            runs[(record['run_id'], record['commit'])][record['grid']] = record
+    if len(runs) < 2:
+        print('Need at least two runs to compare.')
+        return
+    (old_id, old), (new_id, new) = sorted(runs.items())[-2:]
+    print(f'{"grid":>10} {"metric":>22} {str(old_id):>36} {str(new_id):>36} {"ratio":>7}')
+    for grid in new:
+        for key in keys:
+            a = old.get(grid, {}).get(key)
+            b = new[grid].get(key)
+            if a is None or b is None:
+                continue
+            print(f'{grid:>10} {key:>22} {a:>36.6g} {b:>36.6g} {b / a if a else np.inf:>7.2f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--grids', nargs='+', default=DEFAULT_GRIDS)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--no-datum-pages', action='store_true')
+    parser.add_argument('--per-point', action='store_true',
+                        help='time collect() instead of collect_pages()')
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--skip-fly', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare()
+        return
+    run(args.grids, page_size=args.page_size, datum_pages=not args.no_datum_pages,
+        paged=not args.per_point, measure_memory=not args.no_memory,
+        skip_fly=args.skip_fly)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Write and read throughput of the HDF5 chunking and compression modes.
+
+Synthetic camera frames (the test pattern of the simulated camera, with
+shot noise) are written frame by frame, like the areaDetector HDF5 plugin
+does, with each codec of configure_hdf5_compression(), then read back
+through BulkAreaDetectorHDF5Handler: point by point, and as a whole map.
+The file pages are dropped from the OS cache before reading when the
+platform allows it, so the reads hit the disk.
+
+Run it inside a session of this profile (it uses h5py_compression() and the
+handler of that session):
+
+    %run -i benchmarks/hdf5_compression.py --dir /DATA/cam/bench --frames 2000
+    %run -i benchmarks/hdf5_compression.py --modes None LZ4 Blosc --chunk row --nx 100
+
+Every run appends one JSON line per mode to
+benchmarks/results/hdf5_compression.jsonl. Ratios are relative to
+'contiguous': an uncompressed, unchunked dataset, which is what the reads
+are compared with (the 'None' mode is chunked like the others).
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                       'hdf5_compression.jsonl')
+DEFAULT_MODES = ['contiguous', 'None', 'zlib', 'LZ4', 'BSLZ4', 'Blosc']
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(RESULTS), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_frames(num_frames, height, width, nx, seed=0):
+    """Return ``num_frames`` uint16 frames of a raster over a test pattern."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:height, :width]
+    beam = np.exp(-((xx - width / 2) ** 2 + (yy - height / 2) ** 2) /
+                  (2 * (min(height, width) / 8) ** 2))
+    i = np.arange(num_frames)
+    x, y = (i % nx) * 0.01, (i // nx) * 0.01
+    transmission = 0.6 + 0.4 * np.cos(2 * np.pi * x / 0.2) * np.cos(2 * np.pi * y / 0.2)
+    frames = 4000 * transmission[:, None, None] * beam
+    return rng.poisson(frames).clip(0, 65535).astype('uint16')
+
+
+def _drop_cache(filename):
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return True
+    except (AttributeError, OSError):
+        return False
+    finally:
+        os.close(fd)
+
+
+def bench_mode(directory, frames, compression, chunk_frames, level=None,
+               blosc_compressor='LZ4', blosc_shuffle='Byte', nx=None):
+    filename = os.path.join(directory, f'bench_{compression}.h5')
+    num_frames, height, width = frames.shape
+    if compression == 'contiguous':
+        layout = {}
+    else:
+        layout = dict(chunks=(chunk_frames, height, width),
+                      **h5py_compression(compression, level=level,
+                                         blosc_compressor=blosc_compressor,
+                                         blosc_shuffle=blosc_shuffle))
+    t0 = time.perf_counter()
+    with h5py.File(filename, 'w') as f:
+        ds = f.create_dataset('entry/data/data', dtype=frames.dtype,
+                              shape=frames.shape, **layout)
+        for i, frame in enumerate(frames):
+            ds[i] = frame
+    uncached = _drop_cache(filename)
+    write_s = time.perf_counter() - t0
+    size = os.path.getsize(filename)
+
+    resource_kwargs = ({} if compression in ('contiguous', 'None')
+                       else {'compression': compression})
+    handler = BulkAreaDetectorHDF5Handler(filename, **resource_kwargs)
+    t0 = time.perf_counter()
+    for i in range(num_frames):
+        frame = handler(i)
+    read_points_s = time.perf_counter() - t0
+    hdf5_file_cache.clear()
+    _drop_cache(filename)
+
+    t0 = time.perf_counter()
+    stack = handler.stack(num_frames // nx, nx)
+    data = np.asarray(stack.compute() if hasattr(stack, 'compute') else stack)
+    read_map_s = time.perf_counter() - t0
+    hdf5_file_cache.clear()
+    assert np.array_equal(data.reshape(frames.shape), frames)
+    os.remove(filename)
+
+    raw = frames.nbytes / 1e6
+    return {'compression': compression, 'chunk_frames': chunk_frames if layout else None,
+            'level': level, 'file_bytes': size, 'ratio': frames.nbytes / size,
+            'write_s': write_s, 'write_MB_per_s': raw / write_s,
+            'read_points_s': read_points_s, 'read_points_MB_per_s': raw / read_points_s,
+            'read_map_s': read_map_s, 'read_map_MB_per_s': raw / read_map_s,
+            'uncached_reads': uncached}
+
+
+def run(modes=DEFAULT_MODES, num_frames=1000, shape=(480, 640), nx=50, chunk='frame',
+        level=None, directory=None, results=RESULTS):
+    run_id = time.strftime('%Y-%m-%dT%H:%M:%S')
+    commit = _git_commit()
+    frames = make_frames(num_frames - num_frames % nx, *shape, nx)
+    chunk_frames = {'frame': 1, 'row': nx}.get(chunk) or int(chunk)
+    os.makedirs(os.path.dirname(results), exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        records = [bench_mode(tmp, frames, mode, chunk_frames, level=level, nx=nx)
+                   for mode in modes]
+    base = next((r for r in records if r['compression'] == 'contiguous'), None)
+    print(f'{"mode":>10} {"ratio":>6} {"write MB/s":>11} {"points MB/s":>12} '
+          f'{"map MB/s":>9} {"vs contiguous (w/p/m)":>22}')
+    for record in records:
+        record.update({'run_id': run_id, 'commit': commit, 'frames': len(frames),
+                       'shape': list(shape), 'nx': nx, 'chunk': chunk})
+        if base is not None:
+            record['speedup'] = {key: record[key] / base[key] for key in
+                                 ['write_MB_per_s', 'read_points_MB_per_s',
+                                  'read_map_MB_per_s']}
+        speedup = record.get('speedup', {})
+        print(f'{record["compression"]:>10} {record["ratio"]:6.2f} '
+              f'{record["write_MB_per_s"]:11.1f} {record["read_points_MB_per_s"]:12.1f} '
+              f'{record["read_map_MB_per_s"]:9.1f} ' +
+              '/'.join(f'{v:.2f}' for v in speedup.values()).rjust(22))
+        with open(results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', nargs='+', default=DEFAULT_MODES)
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--shape', default='480x640', help='frame height x width')
+    parser.add_argument('--nx', type=int, default=50, help='points per row')
+    parser.add_argument('--chunk', default='frame', help="'frame', 'row' or frames per chunk")
+    parser.add_argument('--level', type=int)
+    parser.add_argument('--dir', help='directory on the disk to measure')
+    args = parser.parse_args(argv)
+    run(args.modes, num_frames=args.frames,
+        shape=tuple(int(n) for n in args.shape.split('x')), nx=args.nx,
+        chunk=args.chunk, level=args.level, directory=args.dir)
+
+
+if __name__ == '__main__':
+    main()
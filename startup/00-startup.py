@@ -1,3 +1,100 @@
+import importlib
+import os
+import time as _time
+
+
+class StartupTimer:
+    """Record (and print) how long each startup file takes to run."""
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.times = {}
+        self._t0 = self._last = _time.perf_counter()
+
+    def mark(self, name):
+        now = _time.perf_counter()
+        self.times[name] = now - self._last
+        self._last = now
+        if self.verbose:
+            print(f'{name:<24s} {self.times[name]:6.2f} s (total {now - self._t0:6.2f} s)')
+
+    def report(self):
+        for name, t in self.times.items():
+            print(f'{name:<24s} {t:6.2f} s')
+        print(f'{"total":<24s} {sum(self.times.values()):6.2f} s')
+
+
+startup_timer = StartupTimer(verbose=os.environ.get('FLYER_STARTUP_REPORT', '1') == '1')
+
+# Defer the heavy imports, the Broker connection and the construction of
+# secondary devices until they are first used:
+LAZY_STARTUP = os.environ.get('FLYER_LAZY_STARTUP', '0') == '1'
+
+
+class LazyObject:
+    """Proxy which creates the wrapped object when it is first used."""
+    def __init__(self, factory):
+        object.__setattr__(self, '_lazy_factory', factory)
+        object.__setattr__(self, '_lazy_obj', None)
+        object.__setattr__(self, '_lazy_hooks', [])
+
+    def _lazy_get(self):
+        if self._lazy_obj is None:
+            object.__setattr__(self, '_lazy_obj', self._lazy_factory())
+            for hook in self._lazy_hooks:
+                hook(self._lazy_obj)
+        return self._lazy_obj
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_get(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_get(), attr, value)
+
+    def __getitem__(self, key):
+        return self._lazy_get()[key]
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_get()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._lazy_get())
+
+    # Proxies of classes can be subclassed and used with isinstance():
+    def __mro_entries__(self, bases):
+        return (self._lazy_get(),)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._lazy_get())
+
+    def __subclasscheck__(self, subclass):
+        return issubclass(subclass, self._lazy_get())
+
+    def __repr__(self):
+        if self._lazy_obj is None:
+            return f'<LazyObject of {self._lazy_factory!r} (not created yet)>'
+        return repr(self._lazy_obj)
+
+
+def on_first_use(obj, func):
+    """Call ``func(obj)`` now, or when a LazyObject is first used."""
+    if isinstance(obj, LazyObject) and obj._lazy_obj is None:
+        obj._lazy_hooks.append(func)
+    else:
+        func(obj._lazy_get() if isinstance(obj, LazyObject) else obj)
+
+
+def lazy_device(factory):
+    """Return ``factory()``, or a LazyObject of it in a lazy startup."""
+    return LazyObject(factory) if LAZY_STARTUP else factory()
+
+
+def lazy_import(module, names):
+    """Bind ``names`` of ``module`` here; the module is imported on first use."""
+    def attribute(name):
+        return LazyObject(lambda: getattr(importlib.import_module(module), name))
+    globals().update({name: attribute(name) for name in names})
+
+
 # Make ophyd listen to pyepics.
 # from ophyd import setup_ophyd
 # setup_ophyd()
@@ -9,8 +106,6 @@ RE = RunEngine(get_history())
 
 # Set up a Broker backed by a temporary directory.
 # In production, a Broker is usually backed by a Mongo database.
-import os
-
 config = {'description': 'HXN lab MongoDB on ws10',
           'metadatastore': {
               'module': 'databroker.headersource.mongo',
@@ -31,12 +126,28 @@ config = {'description': 'HXN lab MongoDB on ws10',
               }
           }
 
-from databroker import Broker
-db = Broker.from_config(config)
+# Run against the simulated stage, PMAC and camera of 08-sim.py instead of
+# the beamline PVs, with a temporary Broker:
+SIMULATION = os.environ.get('FLYER_SIMULATION', '0') == '1'
+
+def _make_broker():
+    from databroker import Broker
+    if SIMULATION:
+        return Broker.named('temp')
+    return Broker.from_config(config)
 
-# Subscribe metadatastore to documents.
-# If this is removed, data is not saved to metadatastore.
-RE.subscribe(db.insert)
+
+db = LazyObject(_make_broker) if LAZY_STARTUP else _make_broker()
+
+
+def _db_insert(name, doc):
+    # Looks up db.insert at call time, so a lazy Broker connects to Mongo
+    # with the first document instead of at startup.
+    db.insert(name, doc)
+
+
+# Documents are saved to metadatastore by the buffered writer subscribed in
+# 01-writer.py.
 
 # Set up SupplementalData.
 from bluesky import SupplementalData
@@ -60,25 +171,39 @@ bec.disable_plots()
 peaks = bec.peaks  # just as alias for less typing
 
 # At the end of every run, verify that files were saved and
-# print a confirmation message.
-from bluesky.callbacks.broker import verify_files_saved
+# print a confirmation message (verify_files_saved is bound below):
 # RE.subscribe(post_run(verify_files_saved), 'stop')
 
-# Import matplotlib and put it in interactive mode.
-import matplotlib.pyplot as plt
-plt.ion()
+def _import_pyplot():
+    # Import matplotlib and put it in interactive mode.
+    import matplotlib.pyplot as plt
+    plt.ion()
 
-# Make plots update live while scans run.
-from bluesky.utils import install_kicker
-install_kicker()
+    # Make plots update live while scans run.
+    from bluesky.utils import install_kicker
+    install_kicker()
+    return plt
+
+
+plt = LazyObject(_import_pyplot) if LAZY_STARTUP else _import_pyplot()
 
 # Optional: set any metadata that rarely changes.
 # RE.md['beamline_id'] = 'YOUR_BEAMLINE_HERE'
 
-# convenience imports
-from bluesky.callbacks import *
-from bluesky.callbacks.broker import *
-from bluesky.simulators import *
+# convenience imports (imported on first use in a lazy startup)
+if LAZY_STARTUP:
+    lazy_import('bluesky.callbacks',
+                ['CallbackBase', 'CallbackCounter', 'LiveFit', 'LiveFitPlot', 'LiveGrid',
+                 'LiveMesh', 'LivePlot', 'LiveRaster', 'LiveScatter', 'LiveTable',
+                 'collector', 'print_metadata'])
+    lazy_import('bluesky.callbacks.broker',
+                ['LiveImage', 'LiveTiffExporter', 'post_run', 'verify_files_saved'])
+    lazy_import('bluesky.simulators',
+                ['check_limits', 'plot_raster_path', 'print_summary', 'summarize_plan'])
+else:
+    from bluesky.callbacks import *
+    from bluesky.callbacks.broker import *
+    from bluesky.simulators import *
 from bluesky.plans import *
 from bluesky.plan_stubs import mv, mvr
 import numpy as np
@@ -95,3 +220,8 @@ def ts_msg_hook(msg):
         msg.args,
         msg.kwargs)
     print('{} {}'.format(t, msg_fmt))
+
+# For per-message durations use plan_profiler (01-profiler.py) instead.
+
+
+startup_timer.mark('00-startup.py')
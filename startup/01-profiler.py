@@ -0,0 +1,190 @@
+import json
+from collections import defaultdict
+
+
+class PlanProfiler:
+    """Time every message of the plans run by the RunEngine.
+
+    It is a RunEngine preprocessor: each message is timed from the moment
+    the plan yields it until the RunEngine sends back the response, so
+    waits on statuses (set, kickoff, complete, ...) are included. The time
+    spent in callbacks wrapped by time_callback() (the document writer) is
+    booked separately as 'insert'.
+
+    How to use:
+    -----------
+    plan_profiler.enable()
+    RE(fly_scan(...))
+    plan_profiler.summary()
+    plan_profiler.export('fly_scan_profile.jsonl')
+
+    Runs whose metadata hold 'predicted_phases' (see 24-estimate.py) are
+    compared with the prediction at the end of the plan, or with compare().
+    """
+    PHASES = {'set': 'setup',
+              'wait': 'setup',
+              'sleep': 'sleeps',
+              'stage': 'stage',
+              'unstage': 'stage',
+              'kickoff': 'flight',
+              'complete': 'flight',
+              'collect': 'collect',
+              'trigger': 'readout',
+              'read': 'readout',
+              'create': 'readout',
+              'save': 'readout',
+              }
+    PHASE_NAMES = ['setup', 'sleeps', 'stage', 'flight', 'collect', 'insert', 'readout',
+                   'other']
+
+    def __init__(self, RE):
+        self.RE = RE
+        self.records = []
+        # {(call, run, plan_name): {phase: seconds}} from the run metadata:
+        self.predictions = {}
+        # Print compare() at the end of every plan with predictions:
+        self.report = True
+        self._insert_time = 0.0
+        self._num_calls = 0
+
+    def enable(self):
+        if self not in self.RE.preprocessors:
+            self.RE.preprocessors.append(self)
+
+    def disable(self):
+        if self in self.RE.preprocessors:
+            self.RE.preprocessors.remove(self)
+
+    def clear(self):
+        self.records.clear()
+        self.predictions.clear()
+
+    def time_callback(self, callback):
+        """Wrap a document callback so its time is booked as 'insert'."""
+        def timed(name, doc):
+            t0 = _time.perf_counter()
+            try:
+                return callback(name, doc)
+            finally:
+                self._insert_time += _time.perf_counter() - t0
+        return timed
+
+    def _phase(self, msg, flight_groups):
+        if msg.command in ('kickoff', 'complete') and msg.kwargs.get('group'):
+            flight_groups.add(msg.kwargs['group'])
+        if msg.command == 'wait' and msg.kwargs.get('group') in flight_groups:
+            return 'flight'
+        return self.PHASES.get(msg.command, 'other')
+
+    def __call__(self, plan):
+        self._num_calls += 1
+        call = self._num_calls
+        run = 0
+        plan_name = None
+        in_run = False
+        flight_groups = set()
+        # Messages outside a run (setup, moves between runs) belong to the
+        # next run, or to the last one if the plan ends without another.
+        pending = []
+        ret = None
+        exc = None
+        while True:
+            try:
+                msg = plan.throw(exc) if exc is not None else plan.send(ret)
+            except StopIteration as stop:
+                for record in pending:
+                    record['run'] = run
+                    record['plan_name'] = plan_name
+                if self.report and any(key[0] == call for key in self.predictions):
+                    self.compare(call)
+                return stop.value
+            if msg.command == 'open_run':
+                run += 1
+                in_run = True
+                plan_name = msg.kwargs.get('plan_name')
+                if 'predicted_phases' in msg.kwargs:
+                    self.predictions[(call, run, plan_name)] = msg.kwargs['predicted_phases']
+                for record in pending:
+                    record['run'] = run
+                    record['plan_name'] = plan_name
+                pending.clear()
+            ret = exc = None
+            t0 = _time.perf_counter()
+            insert0 = self._insert_time
+            try:
+                ret = yield msg
+            except GeneratorExit:
+                plan.close()
+                raise
+            except Exception as error:
+                exc = error
+            finally:
+                insert = self._insert_time - insert0
+                record = {'call': call,
+                          'run': run,
+                          'plan_name': plan_name,
+                          'command': msg.command,
+                          'obj': getattr(msg.obj, 'name', msg.obj and str(msg.obj)),
+                          'phase': self._phase(msg, flight_groups),
+                          'start': t0,
+                          'duration': _time.perf_counter() - t0 - insert,
+                          'insert': insert}
+                self.records.append(record)
+                if not in_run:
+                    pending.append(record)
+            if msg.command == 'close_run':
+                in_run = False
+
+    def breakdown(self):
+        """Return ``{(call, run, plan_name): {phase: seconds}}``."""
+        result = defaultdict(lambda: defaultdict(float))
+        for r in self.records:
+            phases = result[(r['call'], r['run'], r['plan_name'])]
+            phases[r['phase']] += r['duration']
+            phases['insert'] += r['insert']
+        return {key: dict(phases) for key, phases in result.items()}
+
+    def summary(self):
+        phases = self.PHASE_NAMES
+        print(f'{"call":>4} {"run":>3} {"plan":<16}' +
+              ''.join(f'{p:>9}' for p in phases) + f'{"total":>9}')
+        for (call, run, plan_name), times in self.breakdown().items():
+            print(f'{call:>4} {run:>3} {str(plan_name):<16}' +
+                  ''.join(f'{times.get(p, 0):9.3f}' for p in phases) +
+                  f'{sum(times.values()):9.3f}')
+
+    def compare(self, call=None):
+        """Print the achieved and predicted time of every phase.
+
+        Only the runs of plan ``call`` (the last plan by default) which
+        were started with predictions are shown.
+        """
+        if call is None:
+            call = self._num_calls
+        breakdown = self.breakdown()
+        for key, predicted in self.predictions.items():
+            if key[0] != call:
+                continue
+            achieved = breakdown.get(key, {})
+            print(f'Run {key[1]} ({key[2]}): {"predicted":>9} {"achieved":>9} {"ratio":>6}')
+            for phase in self.PHASE_NAMES + ['total']:
+                if phase == 'total':
+                    p, a = sum(predicted.values()), sum(achieved.values())
+                else:
+                    p, a = predicted.get(phase, 0.0), achieved.get(phase, 0.0)
+                if not p and not a:
+                    continue
+                ratio = f'{a / p:6.2f}' if p else f'{"-":>6}'
+                print(f'{phase:>16}: {p:9.3f} {a:9.3f} {ratio}')
+
+    def export(self, filename):
+        """Write one JSON line per message to ``filename``."""
+        with open(filename, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+
+
+plan_profiler = PlanProfiler(RE)
+
+
+startup_timer.mark('01-profiler.py')
@@ -0,0 +1,134 @@
+import atexit
+import queue
+import threading
+import time
+
+import event_model
+
+
+class ListStore:
+    """Stand-in for db.insert which keeps the documents in a list.
+
+    ``latency`` (in seconds) is added to every insert to mimic a remote
+    database.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.docs = []
+
+    def insert(self, name, doc):
+        if self.latency:
+            time.sleep(self.latency)
+        self.docs.append((name, doc))
+
+
+class BufferedDocumentWriter:
+    """Write documents to a store from a background thread.
+
+    The RunEngine callback only puts the document in a queue; a thread
+    inserts them with ``insert(name, doc)``. Consecutive events of one
+    descriptor (and datums of one resource) are combined into event_page
+    (datum_page) documents of up to ``batch_size`` items, which are
+    written once full, when any other document arrives, or after
+    ``flush_interval`` seconds without new documents.
+
+    When the queue holds ``max_queue`` documents the RunEngine waits
+    (backpressure), and a 'stop' document is only returned from after
+    every document of the run has been inserted. An insert error is
+    raised from the next call.
+    """
+    def __init__(self, insert, *, batch_size=1000, max_queue=100000, flush_interval=0.5):
+        self.insert = insert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='document-writer', daemon=True)
+        self._thread.start()
+
+    def __call__(self, name, doc):
+        self._raise_error()
+        self._queue.put((name, doc))  # blocks while the queue is full
+        if name == 'stop':
+            self.flush()
+
+    def flush(self):
+        """Wait until every queued document has been inserted."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Insert the queued documents and stop the thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put((None, None))
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Inserting documents failed') from error
+
+    def _write(self, name, doc, count=1):
+        try:
+            self.insert(name, doc)
+        except Exception as error:
+            if self._error is None:
+                self._error = error
+        finally:
+            for _ in range(count):
+                self._queue.task_done()
+
+    def _write_batch(self, name, docs):
+        if len(docs) == 1:
+            self._write(name, docs[0])
+        elif name == 'event':
+            self._write('event_page', event_model.pack_event_page(*docs), len(docs))
+        else:
+            self._write('datum_page', event_model.pack_datum_page(*docs), len(docs))
+
+    def _write_pending(self, pending):
+        # Datums first, so no event refers to a datum which is not written.
+        for key in sorted(pending):
+            self._write_batch(key[0], pending[key])
+        pending.clear()
+
+    def _run(self):
+        pending = {}  # ('datum', resource) or ('event', descriptor) -> docs
+        while True:
+            try:
+                name, doc = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._write_pending(pending)
+                continue
+            if name is None:
+                self._write_pending(pending)
+                self._queue.task_done()
+                return
+            if name in ('event', 'datum'):
+                key = (name, doc['descriptor'] if name == 'event' else doc['resource'])
+                batch = pending.setdefault(key, [])
+                batch.append(doc)
+                if len(batch) >= self.batch_size:
+                    if name == 'event':
+                        # The datums these events refer to go first:
+                        for datum_key in [k for k in pending if k[0] == 'datum']:
+                            self._write_batch('datum', pending.pop(datum_key))
+                    self._write_batch(name, pending.pop(key))
+            else:
+                self._write_pending(pending)
+                self._write(name, doc)
+
+
+doc_writer = BufferedDocumentWriter(_db_insert)
+
+# Subscribe metadatastore to documents.
+# If this is removed, data is not saved to metadatastore.
+# The time spent handing documents to the writer is profiled as 'insert'.
+RE.subscribe(plan_profiler.time_callback(doc_writer))
+# Insert the documents still queued when IPython exits:
+atexit.register(doc_writer.close)
+
+
+startup_timer.mark('01-writer.py')
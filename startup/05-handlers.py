@@ -0,0 +1,189 @@
+import threading
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+
+class HDF5FileCache:
+    """Keep the most recently used HDF5 files open.
+
+    Opening a file (and walking to its dataset) for every frame dominates
+    the cost of reading a fly scan back, so files are opened once and
+    closed only when they drop out of the cache.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        with self._lock:
+            try:
+                self._files.move_to_end(filename)
+            except KeyError:
+                self._files[filename] = h5py.File(filename, 'r')
+                while len(self._files) > self.maxsize:
+                    _, f = self._files.popitem(last=False)
+                    f.close()
+            return self._files[filename]
+
+    def clear(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+
+hdf5_file_cache = HDF5FileCache()
+
+
+# areaDetector HDF5 plugin codecs (the 'Compression' PV) which need the
+# filter plugins of the hdf5plugin package to be read back:
+HDF5_PLUGIN_CODECS = {'Blosc', 'LZ4', 'BSLZ4'}
+BLOSC_COMPRESSORS = {'BloscLZ': 'blosclz', 'LZ4': 'lz4', 'LZ4HC': 'lz4hc',
+                     'SNAPPY': 'snappy', 'ZLIB': 'zlib', 'ZSTD': 'zstd'}
+
+
+def require_hdf5_filters(compression):
+    """Make sure h5py can decompress data written with ``compression``."""
+    if compression in HDF5_PLUGIN_CODECS:
+        try:
+            import hdf5plugin  # noqa: F401 -- registers the filters with HDF5
+        except ImportError:
+            raise ImportError(f'hdf5plugin is needed to read {compression} '
+                              f'compressed frames') from None
+
+
+def h5py_compression(compression='None', *, level=None,
+                     blosc_compressor='LZ4', blosc_shuffle='Byte'):
+    """Return the h5py create_dataset() keywords of an areaDetector codec.
+
+    The names are those of the HDF5 plugin PVs (Compression, ZLevel,
+    BloscCompressor, BloscCompressLevel and BloscShuffle), so files written
+    by h5py can be compared with files written by the IOC.
+    """
+    if compression == 'None':
+        return {}
+    if compression == 'zlib':
+        return {'compression': 'gzip', 'compression_opts': 6 if level is None else level}
+    require_hdf5_filters(compression)
+    import hdf5plugin
+    if compression == 'LZ4':
+        return dict(hdf5plugin.LZ4())
+    if compression == 'BSLZ4':
+        return dict(hdf5plugin.Bitshuffle())
+    if compression == 'Blosc':
+        shuffle = {'None': hdf5plugin.Blosc.NOSHUFFLE,
+                   'Byte': hdf5plugin.Blosc.SHUFFLE,
+                   'Bit': hdf5plugin.Blosc.BITSHUFFLE}[blosc_shuffle]
+        return dict(hdf5plugin.Blosc(cname=BLOSC_COMPRESSORS[blosc_compressor],
+                                     clevel=5 if level is None else level,
+                                     shuffle=shuffle))
+    raise ValueError(f'Unsupported compression {compression!r}')
+
+
+class BulkAreaDetectorHDF5Handler:
+    """Handler for the 'AD_HDF5' spec which can read many points at once.
+
+    It behaves like the standard handler for one datum at a time, and in
+    addition reads contiguous point ranges with a single slice and exposes
+    the whole stack of frames as a lazy array.
+
+    ``compression`` is recorded in the resource by the HDF5 plugins of
+    this profile when the frames are compressed; it only makes sure the
+    matching decompression filters are loaded.
+    """
+    specs = {'AD_HDF5'}
+    key = 'entry/data/data'
+
+    def __init__(self, filename, frame_per_point=1, compression='None'):
+        require_hdf5_filters(compression)
+        self._filename = filename
+        self._frame_per_point = frame_per_point
+
+    @property
+    def dataset(self):
+        # The file stays open in hdf5_file_cache, so this is cheap.
+        return hdf5_file_cache.get(self._filename)[self.key]
+
+    def __call__(self, point_number):
+        start = point_number * self._frame_per_point
+        stop = start + self._frame_per_point
+        return self.dataset[start:stop].squeeze()
+
+    def read_range(self, start, stop):
+        """Return the frames of the points ``start:stop`` with one read."""
+        return self.dataset[start * self._frame_per_point:
+                            stop * self._frame_per_point]
+
+    def stack(self, ny, nx, *, offset=0):
+        """Return the frames of an ``ny`` by ``nx`` map without reading them.
+
+        The result has the shape ``(ny, nx, height, width)`` with the rows in
+        acquisition order (odd rows of a snake scan run from x_stop to
+        x_start). ``offset`` is the number of the first point of the map in
+        the file. A contiguous, uncompressed dataset is memory-mapped;
+        otherwise a dask array (if dask is installed) or the h5py dataset
+        itself is used to read lazily.
+        """
+        ds = self.dataset
+        height, width = ds.shape[-2:]
+        start = offset * self._frame_per_point
+        num_frames = ny * nx * self._frame_per_point
+        if ds.chunks is None and ds.compression is None and ds.id.get_offset() is not None:
+            frame_bytes = height * width * ds.dtype.itemsize
+            arr = np.memmap(self._filename, dtype=ds.dtype, mode='r',
+                            offset=ds.id.get_offset() + start * frame_bytes,
+                            shape=(num_frames, height, width))
+        else:
+            try:
+                import dask.array
+            except ImportError:
+                arr = ds[start:start + num_frames]
+            else:
+                arr = dask.array.from_array(ds, chunks=ds.chunks or (1, height, width))
+                arr = arr[start:start + num_frames]
+        if self._frame_per_point == 1:
+            return arr.reshape(ny, nx, height, width)
+        return arr.reshape(ny, nx, self._frame_per_point, height, width)
+
+    def get_file_list(self, datum_kwargs):
+        return [self._filename]
+
+
+def fly_scan_handler(header, stream_name='primary', field=None):
+    """Return ``(handler, offset, ny, nx)`` for the frames of a fly scan.
+
+    The datum ids of the fly scan end with the point number in the file,
+    so the lowest one locates the whole map and no event has to be filled.
+    ``offset`` is the number of the first point of the map in the file.
+    """
+    table = header.table(stream_name=stream_name, fill=False)
+    if field is None:
+        field, = [c for c in table.columns if c.endswith('_image')]
+    # The raster flyers describe x with the shape [nx]; the measured
+    # positions of a gathered scan are all different.
+    descriptor = next((d for d in header.descriptors if d['name'] == stream_name), None)
+    shape = descriptor['data_keys'].get('x', {}).get('shape') if descriptor else None
+    nx = shape[0] if shape else len(np.unique(table['x']))
+    ny = len(table) // nx
+    # The rows of the table are not necessarily in the order of the points:
+    offset = min(int(datum_id.rsplit('/', 1)[-1]) for datum_id in table[field])
+    resource = db.reg.resource_given_datum_id(table[field].iloc[0])
+    filename = os.path.join(resource['root'], resource['resource_path'])
+    handler = BulkAreaDetectorHDF5Handler(filename, **resource['resource_kwargs'])
+    return handler, offset, ny, nx
+
+
+def fly_scan_frames(header, stream_name='primary', field=None):
+    """Return the frames of a fly scan as a lazy ``(ny, nx, h, w)`` array."""
+    handler, offset, ny, nx = fly_scan_handler(header, stream_name, field)
+    return handler.stack(ny, nx, offset=offset)
+
+
+on_first_use(db, lambda db: db.reg.register_handler('AD_HDF5', BulkAreaDetectorHDF5Handler,
+                                                  overwrite=True))
+
+
+startup_timer.mark('05-handlers.py')
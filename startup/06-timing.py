@@ -0,0 +1,158 @@
+# Timing model of the raster in pmc/PROG16_XYScan.pmc and of the arbitrary
+# trajectories in pmc/PROG17_Trajectory.pmc, shared by the simulated stage
+# and the fly scan planning tools.
+
+PMAC_MYRES = 10000                          # counts per mm (MYRES)
+PMAC_MAX_SPEED = 6.4 * 1e3 / PMAC_MYRES     # I116: counts/ms -> mm/s
+PMAC_MAX_ACCEL = 0.25 * 1e6 / PMAC_MYRES    # I117: counts/ms^2 -> mm/s^2
+PMAC_TA = 0.010                             # TA10: acceleration time, s
+PMAC_SERVO_PERIOD = 1677653 / 8388608 * 1e-3  # I10: servo cycle, s
+# RAPID moves use the jog speed and acceleration time of the motors, which
+# mc01_backup.CFG sets (I122/I222 = 2, I120/I220 = 100, no S-curve):
+PMAC_RAPID_SPEED = 2 * 1e3 / PMAC_MYRES     # I122: counts/ms -> mm/s
+PMAC_RAPID_TA = 0.100                       # I120: jog acceleration time, s
+
+
+def pmac_move_time(distance, speed, accel_time=None):
+    """Duration of a move of ``distance`` mm at ``speed`` mm/s.
+
+    ``accel_time`` is that of the motion program (TA, I117) by default;
+    pass PMAC_RAPID_TA for RAPID moves.
+    """
+    distance = abs(distance)
+    speed = min(speed, PMAC_MAX_SPEED)
+    if distance == 0 or speed <= 0:
+        return 0.0
+    if accel_time is None:
+        accel_time = max(PMAC_TA, speed / PMAC_MAX_ACCEL)
+    if distance < speed * accel_time:
+        # Triangular profile, the speed is never reached:
+        return 2 * np.sqrt(distance * accel_time / speed)
+    return distance / speed + accel_time
+
+
+def raster_positions(x_start, x_stop, nx, y_start, y_stop, ny, snake=False,
+                     start=0, stop=None):
+    """Return the x and y positions of the points ``start:stop`` of a raster.
+
+    y is the slow axis and x is the fast axis; in snake mode the odd rows
+    run from x_stop back to x_start.
+    """
+    if stop is None:
+        stop = nx * ny
+    row, col = np.divmod(np.arange(start, stop), nx)
+    if snake:
+        odd = row % 2 == 1
+        col[odd] = nx - 1 - col[odd]
+    x = np.linspace(x_start, x_stop, nx)[col]
+    y = np.linspace(y_start, y_stop, ny)[row]
+    return x, y
+
+
+def prog16_timing(*, x_start, x_stop, nx, y_start, y_stop, ny, trigger_rate,
+                  snake=False, trigger_times=False):
+    """Predict the duration of PROG16 for a raster.
+
+    Returns a dict with the programmed and achieved feedrate (mm/s), the
+    trigger period (s), the duration of each phase of the program (s),
+    the total duration (s) and, if ``trigger_times`` is set, the time of
+    every trigger relative to the start of the program.
+    """
+    step_x = (x_stop - x_start) / max(nx - 1, 1)
+    step_y = (y_stop - y_start) / max(ny - 1, 1)
+    trigger_size = step_x / 5
+
+    # F(((P1601 - P1600) / P1604) * P1606), limited by I116:
+    feedrate = (x_stop - x_start) / nx * trigger_rate
+    speed = min(abs(feedrate), PMAC_MAX_SPEED)
+    accel_time = max(PMAC_TA, speed / PMAC_MAX_ACCEL)
+    row_length = abs(x_stop - x_start) + abs(step_x) / 2 + abs(trigger_size)
+    back_length = abs(x_stop - x_start) + abs(step_x)
+
+    phases = {'start': 0.100 + 0.010,  # Dwell 100, Dwell 10
+              'returns': 0.0,
+              'dwells': 0.0,
+              'rows': 0.0,
+              'y_steps': 0.0,
+              }
+    times = np.empty(nx * ny) if trigger_times else None
+    t = phases['start']
+    for row in range(ny):
+        if snake:
+            dwell = 0.100
+        else:
+            # RAPID back to the starting X (already there for the first row):
+            if row > 0:
+                return_time = pmac_move_time(row_length, PMAC_RAPID_SPEED, PMAC_RAPID_TA)
+                phases['returns'] += return_time
+                t += return_time
+            dwell = 1.000
+        dwell += 0.010  # compare setup
+        phases['dwells'] += dwell
+        t += dwell
+
+        # In snake mode every row after the first starts half a step
+        # outside of the field, where the previous row ended:
+        if snake and row > 0:
+            length, first = back_length, abs(step_x) / 2
+        else:
+            length, first = row_length, abs(trigger_size)
+        if times is not None:
+            t_first = t + accel_time / 2 + first / speed
+            times[row * nx:(row + 1) * nx] = t_first + np.arange(nx) * abs(step_x) / speed
+        row_time = pmac_move_time(length, speed)
+        phases['rows'] += row_time
+        t += row_time
+
+        phases['dwells'] += 0.100 + 0.010  # Dwell 100, Dwell 10
+        t += 0.110
+        y_time = pmac_move_time(step_y, PMAC_RAPID_SPEED, PMAC_RAPID_TA)
+        phases['y_steps'] += y_time
+        t += y_time
+
+    timing = {'feedrate': feedrate,
+              'speed': speed,
+              'trigger_period': abs(step_x) / speed if speed else np.inf,
+              'phases': phases,
+              'total': t,
+              }
+    if times is not None:
+        timing['trigger_times'] = times
+    return timing
+
+
+PROG17_MAX_POINTS = 3000  # P2000..P4999 and P5000..P7999
+
+
+def prog17_timing(x, y, *, trigger_rate, trigger_times=False):
+    """Predict the duration of PROG17 for the points ``x``, ``y``.
+
+    Every point is visited ``1 / trigger_rate`` s after the previous one,
+    as long as no segment needs more than the maximum speed (the PMAC
+    would stretch it). Returns a dict with the trigger period (s), the
+    highest segment speed (mm/s), the duration of each phase (s), the total
+    duration (s) and, if ``trigger_times`` is set, the time of every
+    trigger relative to the start of the program.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    period = 1 / trigger_rate
+    steps = np.hypot(np.diff(x), np.diff(y))
+    max_speed = steps.max() / period if len(steps) else 0.0
+    # Stretched segments (the moves are blended, so this is approximate):
+    segment_times = np.maximum(period, steps / PMAC_MAX_SPEED)
+    phases = {'start': 0.100,  # Dwell 100 (the RAPID to the first point is not counted)
+              'points': float(segment_times.sum()),
+              'end': period / 2 + 0.010,  # Dwell on the last point, Dwell 10
+              }
+    timing = {'trigger_period': period,
+              'max_speed': max_speed,
+              'phases': phases,
+              'total': sum(phases.values()),
+              }
+    if trigger_times:
+        timing['trigger_times'] = phases['start'] + np.concatenate([[0], np.cumsum(segment_times)])
+    return timing
+
+
+startup_timer.mark('06-timing.py')
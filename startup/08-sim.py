@@ -0,0 +1,357 @@
+# Simulated HXNStage, PMAC and camera, used instead of the real devices when
+# the profile is started with FLYER_SIMULATION=1 (see 00-startup.py).
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+
+import h5py
+from ophyd import Component as Cpt, Device, Signal
+from ophyd.sim import SynAxis
+
+
+# Time factor of the simulated PMAC (0.1 runs ten times faster than real):
+SIM_TIME_SCALE = float(os.environ.get('FLYER_SIM_TIME_SCALE', '1.0'))
+SIM_FRAME_SHAPE = (64, 80)  # height, width
+
+
+class SimCam(Device):
+    acquire = Cpt(Signal, value=0)
+    acquire_time = Cpt(Signal, value=0.01, kind='config')
+    num_images = Cpt(Signal, value=1, kind='config')
+    image_mode = Cpt(Signal, value='Multiple', kind='config')
+    trigger_mode = Cpt(Signal, value='Fixed Rate', kind='config')
+    array_counter = Cpt(Signal, value=0)
+    # cam1:PSBadFrameCounter_RBV
+    bad_frame_counter = Cpt(Signal, value=0)
+
+
+class SimArraySize(Device):
+    height = Cpt(Signal, value=SIM_FRAME_SHAPE[0])
+    width = Cpt(Signal, value=SIM_FRAME_SHAPE[1])
+
+
+class SimStatsPlugin(Device):
+    """Total of every frame, like Stats1: of the camera."""
+    array_counter = Cpt(Signal, value=0)
+    unique_id = Cpt(Signal, value=0)
+    total = Cpt(Signal, value=0.0, kind='hinted')
+
+
+class SimHDF5Plugin(Device):
+    """Writes the frames of SimProsilica like HDF5PluginWithFileStore."""
+    array_size = Cpt(SimArraySize, '')
+    array_counter = Cpt(Signal, value=0)
+    capture = Cpt(Signal, value=0)
+    num_capture = Cpt(Signal, value=0, kind='config')
+    num_captured = Cpt(Signal, value=0)
+    # HDF1:DroppedArrays_RBV
+    dropped_arrays = Cpt(Signal, value=0)
+    # Chunking and compression (see configure_hdf5_compression):
+    num_row_chunks = Cpt(Signal, value=0, kind='config')
+    num_col_chunks = Cpt(Signal, value=0, kind='config')
+    num_frames_chunks = Cpt(Signal, value=1, kind='config')
+    compression = Cpt(Signal, value='None', kind='config')
+    zlevel = Cpt(Signal, value=6, kind='config')
+    blosc_compressor = Cpt(Signal, value='LZ4', kind='config')
+    blosc_compress_level = Cpt(Signal, value=5, kind='config')
+    blosc_shuffle = Cpt(Signal, value='Byte', kind='config')
+
+    def __init__(self, *args, write_path_template, root, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_path_template = write_path_template
+        self.reg_root = root
+        self.chunk = 'frame'
+        self.compression_kwargs = {}
+        self._file = None
+        self._dataset = None
+        self._asset_docs_cache = deque()
+
+    def stage(self):
+        super().stage()
+        path = datetime.now().strftime(self.write_path_template)
+        os.makedirs(path, exist_ok=True)
+        filename = os.path.join(path, f'{uuid.uuid4().hex[:18]}_000000.h5')
+        num_frames = int(self.num_capture.get()) or int(self.parent.cam.num_images.get())
+        height, width = self.array_size.height.get(), self.array_size.width.get()
+        compression = self.compression.get()
+        if compression == 'None':
+            level = None
+        elif compression == 'zlib':
+            level = self.zlevel.get()
+        else:
+            level = self.blosc_compress_level.get()
+        self._file = h5py.File(filename, 'w')
+        self._dataset = self._file.create_dataset(
+            'entry/data/data', dtype='uint16', shape=(num_frames, height, width),
+            chunks=(min(max(int(self.num_frames_chunks.get()), 1), max(num_frames, 1)),
+                    int(self.num_row_chunks.get()) or height,
+                    int(self.num_col_chunks.get()) or width),
+            **h5py_compression(compression, level=level,
+                               blosc_compressor=self.blosc_compressor.get(),
+                               blosc_shuffle=self.blosc_shuffle.get()))
+        self.num_captured.put(0)
+        self.capture.put(1)
+        self._asset_docs_cache.append(
+            ('resource', {'spec': 'AD_HDF5',
+                          'root': self.reg_root,
+                          'resource_path': os.path.relpath(filename, self.reg_root),
+                          'resource_kwargs': {'frame_per_point': 1,
+                                              **self.compression_kwargs},
+                          'path_semantics': 'posix',
+                          'uid': str(uuid.uuid4())}))
+
+    def unstage(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.capture.put(0)
+        super().unstage()
+
+    def collect_asset_docs(self):
+        items = list(self._asset_docs_cache)
+        self._asset_docs_cache.clear()
+        yield from items
+
+    def write_frame(self, frame):
+        self.array_counter.put(self.array_counter.get() + 1)
+        i = int(self.num_captured.get())
+        if self._dataset is None or i >= len(self._dataset):
+            self.dropped_arrays.put(self.dropped_arrays.get() + 1)
+            return
+        self._dataset[i] = frame
+        self.num_captured.put(i + 1)
+
+
+class SimProsilica(Device):
+    """Camera triggered by SimHXNStage, writing real HDF5 files."""
+    cam = Cpt(SimCam, '')
+    stats1 = Cpt(SimStatsPlugin, '')
+    hdf5 = Cpt(SimHDF5Plugin, '',
+               write_path_template=os.path.join(os.environ.get('FLYER_SIM_ROOT', '/tmp/sim_cam'),
+                                                '%Y/%m/%d/'),
+               root=os.environ.get('FLYER_SIM_ROOT', '/tmp/sim_cam'))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._is_flying = False
+        self._last_trigger = None
+        yy, xx = np.mgrid[:SIM_FRAME_SHAPE[0], :SIM_FRAME_SHAPE[1]]
+        self._beam = np.exp(-((xx - SIM_FRAME_SHAPE[1] / 2) ** 2 +
+                              (yy - SIM_FRAME_SHAPE[0] / 2) ** 2) / (2 * 8.0 ** 2))
+
+    @property
+    def is_flying(self):
+        return self._is_flying
+
+    @is_flying.setter
+    def is_flying(self, is_flying):
+        self._is_flying = is_flying
+
+    def stage(self):
+        self._last_trigger = None
+        return super().stage()
+
+    def trigger_frame(self, x, y, t):
+        """Take a frame at the sample position (x, y), triggered at time t.
+
+        A trigger arriving during the exposure of the previous frame is
+        counted as a bad frame, like the Prosilica does.
+        """
+        if not self.cam.acquire.get():
+            return
+        if (self._last_trigger is not None and
+                t - self._last_trigger < self.cam.acquire_time.get()):
+            self.cam.bad_frame_counter.put(self.cam.bad_frame_counter.get() + 1)
+            return
+        self._last_trigger = t
+        self.cam.array_counter.put(self.cam.array_counter.get() + 1)
+        # A periodic test pattern in front of a gaussian beam:
+        transmission = 0.6 + 0.4 * np.cos(2 * np.pi * x / 0.2) * np.cos(2 * np.pi * y / 0.2)
+        frame = 4000 * transmission * self.cam.acquire_time.get() / 0.01 * self._beam
+        frame = np.clip(frame, 0, 65535).astype('uint16')
+        # The counters are posted before the statistics, like areaDetector does:
+        self.stats1.array_counter.put(self.stats1.array_counter.get() + 1)
+        self.stats1.unique_id.put(self.cam.array_counter.get())
+        self.stats1.total.put(float(frame.sum()))
+        self.hdf5.write_frame(frame)
+
+
+class _SimStartScan(Signal):
+    def put(self, value, **kwargs):
+        super().put(value, **kwargs)
+        if value:
+            self.parent.start()
+
+
+class _SimAbortScan(Signal):
+    def put(self, value, **kwargs):
+        super().put(value, **kwargs)
+        if value:
+            self.parent.abort()
+
+
+class _SimMotionProgram(Device):
+    """Runs ``_run`` (a PMAC motion program) in a thread when started."""
+    def __init__(self, *args, camera, scan_in_progress, time_scale=SIM_TIME_SCALE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.camera = camera
+        self.scan_in_progress = scan_in_progress
+        self.time_scale = time_scale
+        # SimPMACGather recording the triggers (see 23-gather.py):
+        self.gather = None
+        self._thread = None
+        self._abort = threading.Event()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError('A scan is already in progress')
+        self._abort.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def abort(self):
+        """Stop the program and the triggers, like PLC 18."""
+        self._abort.set()
+
+    def _play(self, timing, x, y):
+        """Trigger the camera at the points ``x``, ``y`` at the times of ``timing``."""
+        self.scan_in_progress.put(1)
+        # The trigger times restart at 0 with every program:
+        self.camera._last_trigger = None
+        t0 = time.monotonic()
+        for t, xi, yi in zip(timing['trigger_times'], x, y):
+            delay = t0 + t * self.time_scale - time.monotonic()
+            if self._abort.wait(max(delay, 0)):
+                break
+            self.camera.trigger_frame(xi, yi, t)
+            if self.gather is not None:
+                self.gather.record(t, xi, yi)
+        delay = t0 + timing['total'] * self.time_scale - time.monotonic()
+        self._abort.wait(max(delay, 0))
+        self.scan_in_progress.put(0)
+
+
+class SimHXNStage(_SimMotionProgram):
+    """HXNStage running PROG16 with the timing of prog16_timing()."""
+    x_start = Cpt(Signal, value=0.0)
+    x_stop = Cpt(Signal, value=0.1)
+    nx = Cpt(Signal, value=5)
+    y_start = Cpt(Signal, value=0.0)
+    y_stop = Cpt(Signal, value=0.1)
+    ny = Cpt(Signal, value=3)
+    trigger_rate = Cpt(Signal, value=1)
+    snake = Cpt(Signal, value=0)
+    start_scan = Cpt(_SimStartScan, value=0)
+    abort_scan = Cpt(_SimAbortScan, value=0)
+
+    def _run(self):
+        raster = {'x_start': self.x_start.get(), 'x_stop': self.x_stop.get(),
+                  'nx': int(self.nx.get()),
+                  'y_start': self.y_start.get(), 'y_stop': self.y_stop.get(),
+                  'ny': int(self.ny.get()),
+                  'snake': bool(self.snake.get())}
+        timing = prog16_timing(trigger_rate=self.trigger_rate.get(),
+                               trigger_times=True, **raster)
+        x, y = raster_positions(**raster)
+        self._play(timing, x, y)
+
+
+class SimHXNTrajectory(_SimMotionProgram):
+    """HXNTrajectory running PROG17 with the timing of prog17_timing()."""
+    x = Cpt(Signal, value=np.zeros(0))
+    y = Cpt(Signal, value=np.zeros(0))
+    num_points = Cpt(Signal, value=0)
+    trigger_rate = Cpt(Signal, value=1)
+    start_scan = Cpt(_SimStartScan, value=0)
+    abort_scan = Cpt(_SimAbortScan, value=0)
+
+    def _run(self):
+        num_points = int(self.num_points.get())
+        x = np.asarray(self.x.get())[:num_points]
+        y = np.asarray(self.y.get())[:num_points]
+        timing = prog17_timing(x, y, trigger_rate=self.trigger_rate.get(),
+                               trigger_times=True)
+        self._play(timing, x, y)
+
+
+class SimPMACGather(Device):
+    """PMAC gather buffer holding the triggers of the simulated programs.
+
+    Each trigger is stored as a low and a high sample of the compare
+    output around the trigger time, with encoder noise, in the layout of
+    pmc/Gather.pmc.
+    """
+    period = Cpt(Signal, value=10)
+    capacity = Cpt(Signal, value=1000000)
+    num_samples = Cpt(Signal, value=0)
+    servo = Cpt(Signal, value=np.zeros(0))
+    enc1 = Cpt(Signal, value=np.zeros(0))
+    enc2 = Cpt(Signal, value=np.zeros(0))
+    status = Cpt(Signal, value=np.zeros(0))
+
+    def __init__(self, *args, noise=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.noise = noise  # encoder counts
+        self.start_time = None
+        self._triggers = []
+
+    def gather_period(self, *, duration, pulse_width):
+        return max(1, int(pulse_width / 2 / PMAC_SERVO_PERIOD))
+
+    def start(self, period):
+        self.period.put(period)
+        self.start_time = time.time()
+        self._triggers = []
+
+    def record(self, t, x, y):
+        self._triggers.append((t, x, y))
+
+    def finish(self):
+        t, x, y = (np.array(values) for values in zip(*self._triggers)) if self._triggers \
+            else (np.zeros(0),) * 3
+        dt = self.period.get()
+        # Servo cycle of the samples just before and at each trigger:
+        cycles = np.round(t / PMAC_SERVO_PERIOD / dt) * dt
+        servo = np.stack([cycles - dt, cycles], axis=1).ravel()
+        rng = np.random.default_rng()
+
+        def encoder(position):
+            counts = np.repeat(position * PMAC_MYRES, 2)
+            return np.round(counts + rng.normal(0, self.noise, len(counts)))
+
+        status = np.tile([0, 1 << 9], len(t))
+        self.servo.put(servo.astype(np.int64) % (1 << 24))
+        self.enc1.put(encoder(x).astype(np.int64))
+        self.enc2.put(encoder(y).astype(np.int64))
+        self.status.put(status)
+        self.num_samples.put(len(servo))
+        return {name: np.asarray(getattr(self, name).get())
+                for name in ['servo', 'enc1', 'enc2', 'status']}
+
+
+class SimSampleMotors(Device):
+    sx = Cpt(SynAxis)
+    sy = Cpt(SynAxis)
+    sth = Cpt(SynAxis)
+
+
+class SimLaserMotors(Device):
+    lx = Cpt(SynAxis)
+    ly = Cpt(SynAxis)
+
+
+class SimMotorBundle(Device):
+    x = Cpt(SynAxis)
+    y = Cpt(SynAxis)
+    z = Cpt(SynAxis)
+
+
+class SimSampleCentering(Device):
+    x = Cpt(SynAxis)
+    z = Cpt(SynAxis)
+
+
+startup_timer.mark('08-sim.py')
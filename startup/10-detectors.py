@@ -8,12 +8,14 @@ from ophyd import (ProsilicaDetector, ProsilicaDetectorCam,
                    TransformPlugin, ProcessPlugin, Device)
 from ophyd.areadetector.cam import AreaDetectorCam
 from ophyd.areadetector.base import ADComponent, EpicsSignalWithRBV
+from ophyd.areadetector.plugins import PluginBase
 from ophyd.areadetector.filestore_mixins import (FileStoreTIFFIterativeWrite,
                                                  FileStoreHDF5IterativeWrite,
                                                  FileStoreBase, new_short_uid,
                                                  FileStoreIterativeWrite)
 from ophyd import Component as Cpt, Signal
 from ophyd.utils import set_and_wait
+from collections import OrderedDict
 from pathlib import PurePath
 from bluesky.plan_stubs import stage, unstage, open_run, close_run, trigger_and_read, pause
 
@@ -27,6 +29,8 @@ class ProsilicaDetectorCamV33(ProsilicaDetectorCam):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.stage_sigs['wait_for_plugins'] = 'Yes'
+        # The camera rounds the exposure time to its clock resolution:
+        self.acquire_time.tolerance = 1e-5
 
     def ensure_nonblocking(self):
         self.stage_sigs['wait_for_plugins'] = 'Yes'
@@ -49,12 +53,38 @@ class TIFFPluginWithFileStore(TIFFPlugin, FileStoreTIFFIterativeWrite):
 
 class HDF5PluginWithFileStore(HDF5Plugin, FileStoreHDF5IterativeWrite):
     """Add this as a component to detectors that write HDF5s."""
+    blosc_compressor = ADComponent(EpicsSignalWithRBV, 'BloscCompressor',
+                                   string=True, kind='config')
+    blosc_compress_level = ADComponent(EpicsSignalWithRBV, 'BloscCompressLevel',
+                                       kind='config')
+    blosc_shuffle = ADComponent(EpicsSignalWithRBV, 'BloscShuffle',
+                                string=True, kind='config')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # See configure_hdf5_compression():
+        self.chunk = 'frame'
+        self.compression_kwargs = {}
+
+    def stage(self):
+        # 'capture' opens the file; the chunking and compression settings
+        # added to stage_sigs after it (configure_hdf5_compression, Flyer)
+        # must be written before, or the file is created without them.
+        if 'capture' in self.stage_sigs:
+            self.stage_sigs.move_to_end('capture')
+        return super().stage()
+
     def get_frames_per_point(self):
         if not self.parent.is_flying:
             return self.parent.cam.num_images.get()
         else:
             return 1
 
+    def _generate_resource(self, resource_kwargs):
+        # Tell the readers which decompression filters they need:
+        resource_kwargs = dict(resource_kwargs, **self.compression_kwargs)
+        return super()._generate_resource(resource_kwargs)
+
 
 class TIFFPluginEnsuredOff(TIFFPlugin):
     """Add this as a component to detectors that do not write TIFFs."""
@@ -112,15 +142,105 @@ class StandardProsilicaWithHDF5(StandardProsilica):
                root='/DATA/cam')
 
 
-# This camera is the default one (with the HDF5 plugin):
-vis_eye1 = StandardProsilicaWithHDF5('XF:03ID-BI{CAM:1}', name='vis_eye1')
-vis_eye1.cam.ensure_nonblocking()
+def configure_hdf5_compression(plugin, compression='None', *, level=None,
+                               chunk='frame', blosc_compressor='LZ4',
+                               blosc_shuffle='Byte'):
+    """Set the chunking and compression the HDF5 plugin applies when staged.
+
+    How to use:
+    -----------
+    configure_hdf5_compression(vis_eye1.hdf5, 'Blosc', chunk='row')
+
+    Parameters
+    ----------
+    plugin : HDF5PluginWithFileStore or SimHDF5Plugin
+        the file plugin of the camera
+    compression : {'None', 'zlib', 'LZ4', 'BSLZ4', 'Blosc'}, optional
+        the areaDetector codec
+    level : integer, optional
+        compression level of 'zlib' and 'Blosc'
+    chunk : 'frame', 'row' or integer, optional
+        number of frames per chunk: one frame, one row of the fly scan
+        (set from the HXNStage when the Flyer is staged), or a fixed number
+    blosc_compressor : str, optional
+        BloscCompressor: 'BloscLZ', 'LZ4', 'LZ4HC', 'SNAPPY', 'ZLIB' or 'ZSTD'
+    blosc_shuffle : str, optional
+        BloscShuffle: 'None', 'Byte' or 'Bit'
+    """
+    # Fail now rather than when the data is read back:
+    h5py_compression(compression, level=level, blosc_compressor=blosc_compressor,
+                     blosc_shuffle=blosc_shuffle)
+    # 0 rows/columns per chunk means the full frame:
+    plugin.stage_sigs.update([('num_row_chunks', 0),
+                              ('num_col_chunks', 0),
+                              ('compression', compression)])
+    if chunk == 'row':
+        # Set by the Flyer for every staging, from the rows of the trajectory:
+        plugin.stage_sigs.pop('num_frames_chunks', None)
+    else:
+        plugin.stage_sigs['num_frames_chunks'] = 1 if chunk == 'frame' else int(chunk)
+    if compression == 'zlib' and level is not None:
+        plugin.stage_sigs['zlevel'] = level
+    if compression == 'Blosc':
+        plugin.stage_sigs.update([('blosc_compressor', blosc_compressor),
+                                  ('blosc_shuffle', blosc_shuffle)])
+        if level is not None:
+            plugin.stage_sigs['blosc_compress_level'] = level
+    plugin.chunk = chunk
+    plugin.compression_kwargs = {} if compression == 'None' else {'compression': compression}
+
+
+# Queue size of the plugins kept running during a fly scan, and minimum time
+# between the frames shown by the image plugin (the live view):
+FLIGHT_QUEUE_SIZE = 200
+FLIGHT_IMAGE_PERIOD = 0.2
+
+
+def flight_profile_sigs(detector, keep=('stats1',), *, queue_size=FLIGHT_QUEUE_SIZE,
+                        image_period=FLIGHT_IMAGE_PERIOD):
+    """Return the stage_sigs which strip the plugin chain down for a fly scan.
+
+    Only the file plugin, the plugins in ``keep`` and the plugins feeding
+    them (following the NDArrayPort of each plugin) keep processing every
+    frame, with a deeper queue. The image plugin is throttled to one frame
+    every ``image_period`` seconds, the other plugins are disabled, and the
+    kept stats plugins compute nothing but the basic statistics. Staging
+    with these stage_sigs restores the previous settings on unstage.
+    """
+    plugins = {name: getattr(detector, name) for name in detector.component_names
+               if isinstance(getattr(detector, name), PluginBase)}
+    if not plugins:
+        return {}
+    ports = {plugin.port_name.get(): name for name, plugin in plugins.items()}
+    needed = set()
+    todo = [name for name in list(keep) + ['hdf5', 'tiff'] if name in plugins]
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            upstream = ports.get(plugins[name].nd_array_port.get())
+            if upstream is not None:
+                todo.append(upstream)
+
+    sigs = OrderedDict()
+    for name, plugin in plugins.items():
+        if name in needed:
+            sigs[f'{name}.enable'] = 1
+            sigs[f'{name}.queue_size'] = queue_size
+            if isinstance(plugin, StatsPlugin):
+                sigs[f'{name}.compute_centroid'] = 'No'
+                sigs[f'{name}.compute_histogram'] = 'No'
+                sigs[f'{name}.compute_profiles'] = 'No'
+                sigs[f'{name}.compute_statistics'] = 'Yes'
+        elif isinstance(plugin, ImagePlugin):
+            sigs[f'{name}.min_callback_time'] = image_period
+        else:
+            sigs[f'{name}.enable'] = 0
+    return sigs
 
-# vis_eye1 = StandardProsilica('XF:03ID-BI{CAM:1}', name='vis_eye1')
-vis_eye1_tiff = StandardProsilicaWithTIFF('XF:03ID-BI{CAM:1}', name='vis_eye1_tiff')
-vis_eye1_tiff.cam.ensure_nonblocking()
 
-for camera in [vis_eye1, vis_eye1_tiff]:
+def configure_camera(camera):
+    camera.cam.ensure_nonblocking()
     camera.read_attrs = ['stats1', 'stats2', 'stats3', 'stats4', 'stats5']
     for plugin_type in ['hdf5', 'tiff']:
         if hasattr(camera, plugin_type):
@@ -150,3 +270,20 @@ for camera in [vis_eye1, vis_eye1_tiff]:
         camera.stage_sigs[camera.tiff.array_counter] = 0
     camera.stats1.total.kind = 'hinted'
 
+
+if SIMULATION:
+    vis_eye1 = SimProsilica(name='vis_eye1')
+else:
+    # This camera is the default one (with the HDF5 plugin); the cameras
+    # are only connected when first used in a lazy startup:
+    vis_eye1 = lazy_device(lambda: StandardProsilicaWithHDF5('XF:03ID-BI{CAM:1}',
+                                                             name='vis_eye1'))
+    on_first_use(vis_eye1, configure_camera)
+
+    # vis_eye1 = StandardProsilica('XF:03ID-BI{CAM:1}', name='vis_eye1')
+    vis_eye1_tiff = lazy_device(lambda: StandardProsilicaWithTIFF('XF:03ID-BI{CAM:1}',
+                                                                  name='vis_eye1_tiff'))
+    on_first_use(vis_eye1_tiff, configure_camera)
+
+
+startup_timer.mark('10-detectors.py')
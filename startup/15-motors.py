@@ -1,4 +1,8 @@
-from ophyd import EpicsMotor, Device, Component as Cpt
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ophyd import EpicsMotor, Device, Kind, Component as Cpt
 
 
 class SampleMotors(Device):
@@ -20,24 +24,153 @@ class SampleCentering(Device):
     z = Cpt(EpicsMotor, 'ZF}Mtr')
 
 
-# Motors in [mc01:10.3.0.111] Kohzu Stage1:
-sample = SampleMotors('XF:03IDC-ES{Smpl:1-Ax:', name='sample')
-laser = LaserMotors('XF:03IDC-ES{Laser:1-Ax:', name='laser')
-cam_motors = MotorBundle('XF:03IDC-ES{Cam:1-Ax:', name='cam_motors')
+if SIMULATION:
+    sample = SimSampleMotors(name='sample')
+    laser = SimLaserMotors(name='laser')
+    cam_motors = SimMotorBundle(name='cam_motors')
+    osa = SimMotorBundle(name='osa')
+    smp_cntr = SimSampleCentering(name='smp_cntr')
+    dropped_hdf5_frames = vis_eye1.hdf5.dropped_arrays
+    total_bad_frames = vis_eye1.cam.bad_frame_counter
+else:
+    # Motion devices are only created when first used in a lazy startup:
+
+    # Motors in [mc01:10.3.0.111] Kohzu Stage1:
+    sample = lazy_device(lambda: SampleMotors('XF:03IDC-ES{Smpl:1-Ax:', name='sample'))
+    laser = lazy_device(lambda: LaserMotors('XF:03IDC-ES{Laser:1-Ax:', name='laser'))
+    cam_motors = lazy_device(lambda: MotorBundle('XF:03IDC-ES{Cam:1-Ax:', name='cam_motors'))
+
+    # Filter motors in mc03-smartact.opi:
+    osa = lazy_device(lambda: MotorBundle('XF:03IDC-ES{Fltr:1-Ax:', name='osa'))
+
+    # Sample centering in mc02-ecc100.opi:
+    smp_cntr = lazy_device(lambda: SampleCentering('XF:03IDC-ES{Smpl:1-Ax:', name='smp_cntr'))
+
+    # Dropped HDF5 frames:
+    dropped_hdf5_frames = EpicsSignalRO('XF:03ID-BI{CAM:1}HDF1:DroppedArrays_RBV', name='dropped_hdf5_frames')
+    total_bad_frames = EpicsSignalRO('XF:03ID-BI{CAM:1}cam1:PSBadFrameCounter_RBV', name='total_bad_frames')
+
+
+class ParallelBaseline:
+    """Read many devices as one, concurrently and from monitors.
+
+    The signals are read in a thread pool instead of one device after the
+    other. Each signal is monitored after its first reading, and its last
+    monitored value is reused as long as the signal stays connected (and,
+    if ``max_age`` is given, is not older than ``max_age`` seconds).
+
+    With ``readback_only`` only the hinted fields of each device are read
+    (the readback of a motor, not its setpoint), and the configuration of
+    the devices is not recorded.
+    """
+    def __init__(self, devices, *, name='baseline', readback_only=False,
+                 monitor=True, max_age=None, max_workers=8):
+        self.name = name
+        self.parent = None
+        self.devices = list(devices)
+        self.readback_only = readback_only
+        self.monitor = monitor
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=name)
+        self._lock = threading.Lock()
+        # signal -> (reading, time.monotonic() of the reading)
+        self._cache = {}
+        self._monitors = {}
+
+    def _resolve(self, device):
+        return device._lazy_get() if isinstance(device, LazyObject) else device
+
+    def _signals(self, device):
+        device = self._resolve(device)
+        if not isinstance(device, Device):
+            return [device]
+        signals = [sig for sig in (getattr(device, attr) for attr in device.read_attrs)
+                   if not isinstance(sig, Device)]
+        if self.readback_only:
+            hinted = [sig for sig in signals if Kind.hinted in sig.kind]
+            signals = hinted or signals
+        return signals
+
+    @property
+    def signals(self):
+        return [sig for device in self.devices for sig in self._signals(device)]
+
+    def _update(self, value, timestamp, obj, **kwargs):
+        with self._lock:
+            self._cache[obj] = ({obj.name: {'value': value, 'timestamp': timestamp}},
+                                time.monotonic())
+
+    def _read_signal(self, sig):
+        reading = sig.read()
+        with self._lock:
+            self._cache[sig] = (reading, time.monotonic())
+        if self.monitor and sig not in self._monitors:
+            self._monitors[sig] = sig.subscribe(self._update, run=False)
+        return reading
+
+    def _cached(self, sig, now):
+        if sig not in self._monitors or not getattr(sig, 'connected', True):
+            return None
+        with self._lock:
+            reading, received = self._cache.get(sig, (None, None))
+        if reading is None or (self.max_age is not None and now - received > self.max_age):
+            return None
+        return reading
+
+    def read(self):
+        now = time.monotonic()
+        result = {}
+        stale = []
+        for sig in self.signals:
+            reading = self._cached(sig, now)
+            if reading is None:
+                stale.append(sig)
+            else:
+                result.update(reading)
+        for reading in self._executor.map(self._read_signal, stale):
+            result.update(reading)
+        return result
+
+    def describe(self):
+        result = {}
+        for description in self._executor.map(lambda sig: sig.describe(), self.signals):
+            result.update(description)
+        return result
+
+    def _configuration(self, method):
+        if self.readback_only:
+            return {}
+        result = {}
+        devices = [self._resolve(device) for device in self.devices]
+        for config in self._executor.map(lambda device: getattr(device, method)(), devices):
+            result.update(config)
+        return result
+
+    def read_configuration(self):
+        return self._configuration('read_configuration')
+
+    def describe_configuration(self):
+        return self._configuration('describe_configuration')
 
-# Filter motors in mc03-smartact.opi:
-osa = MotorBundle('XF:03IDC-ES{Fltr:1-Ax:', name='osa')
+    def clear(self):
+        """Stop the monitors and forget the cached values."""
+        for sig, cid in self._monitors.items():
+            sig.unsubscribe(cid)
+        self._monitors.clear()
+        with self._lock:
+            self._cache.clear()
 
-# Sample centering in mc02-ecc100.opi:
-smp_cntr = SampleCentering('XF:03IDC-ES{Smpl:1-Ax:', name='smp_cntr')
 
-# Dropped HDF5 frames:
-dropped_hdf5_frames = EpicsSignalRO('XF:03ID-BI{CAM:1}HDF1:DroppedArrays_RBV', name='dropped_hdf5_frames')
-total_bad_frames = EpicsSignalRO('XF:03ID-BI{CAM:1}cam1:PSBadFrameCounter_RBV', name='total_bad_frames')
+# The baseline is read before and after every run. Use
+# baseline_reader.readback_only = True to record only the readbacks, without
+# the other fields and the configuration of the devices.
+baseline_reader = ParallelBaseline([sample, laser, cam_motors,
+                                    osa,
+                                    smp_cntr,
+                                    dropped_hdf5_frames, total_bad_frames,
+                                   ])
+sd.baseline = [baseline_reader]
 
-sd.baseline = [sample, laser, cam_motors,
-               osa,
-               smp_cntr,
-               dropped_hdf5_frames, total_bad_frames,
-              ]
 
+startup_timer.mark('15-motors.py')
@@ -2,44 +2,164 @@ import bluesky.plans as bp
 import bluesky.plan_stubs as bps
 import bluesky.preprocessors as bpp
 import itertools
+import threading
 import time
-from ophyd import EpicsMotor, MotorBundle, Component, EpicsSignal, Device
-from ophyd.status import SubscriptionStatus
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ophyd import EpicsMotor, MotorBundle, Component, EpicsSignal, Device, Signal
+from ophyd.status import DeviceStatus, SubscriptionStatus
 from ophyd import set_and_wait
+from bluesky.utils import FailedStatus
 
 
 class Flyer:
-    def __init__(self, detector, hxn_stage):
+    def __init__(self, detectors, hxn_stage, *, page_size=1000, datum_pages=False,
+                 max_dropped_frames=0, frame_timeout=5.0, on_mismatch='raise',
+                 run_engine=None, flight_profile=True, gather=None):
         self.name = 'flyer'
         self.parent = None
-        self.detector = detector
+        # Cameras wired to the same compare output; they are all staged,
+        # watched and collected together. self.detector is the first one.
+        if not isinstance(detectors, (list, tuple)):
+            detectors = [detectors]
+        if not detectors:
+            raise ValueError('At least one detector is needed')
+        self.detectors = list(detectors)
+        self.detector = self.detectors[0]
         self.hxn_stage = hxn_stage
+        # Number of points per event page emitted by collect_pages():
+        self.page_size = page_size
+        # Emit 'datum_page' documents instead of one 'datum' per point. Only
+        # the RunEngines which accept them from collect_asset_docs() (bluesky
+        # 1.8 to 1.10, not 1.11 and later) can use this:
+        self.datum_pages = datum_pages
+        # Name of the event stream filled by collect():
+        self.stream_name = 'primary'
+        # Frame watchdog (see complete()): number of dropped/bad frames
+        # tolerated per trajectory, time allowed for the last frames to
+        # arrive after the stage stopped, and what to do on a mismatch
+        # ('raise' fails the scan with DataMismatch and aborts the motion
+        # program, 'pause' pauses ``run_engine`` at its next checkpoint,
+        # once the points of the flight are collected; without a
+        # run_engine 'pause' raises too):
+        self.max_dropped_frames = max_dropped_frames
+        self.frame_timeout = frame_timeout
+        self.on_mismatch = on_mismatch
+        self.run_engine = run_engine
+        # Strip the plugin chain down while staged (see flight_profile_sigs):
+        self.flight_profile = flight_profile
+        # PMAC gather buffer (see 23-gather.py) giving the measured position
+        # and time of every trigger; the points are then published once the
+        # flight is over:
+        self.gather = gather
+        # Called with the flyer once the trajectory of a kickoff is known
+        # (see LiveFlyMap in 40-livemap.py):
+        self.kickoff_callbacks = []
+        self._gathering = False
+        self._gathered = None
+        self._trigger_times = None
+        self._bad_frame_counters = {}
         self._traj_info = {}
+        # The following are keyed by detector name:
         self._array_size = {}
-        self._datum_ids = []
-        if hasattr(self.detector, 'hdf5'):
-            self.plugin_type = 'hdf5'
-        elif hasattr(self.detector, 'tiff'):
-            self.plugin_type = 'tiff'
-        else:
-            raise ValueError(f'No hdf5 or tiff plugins were found for {self.detector.name}')
-
-    def stage(self):
+        self._resource_uids = {}
+        self._complete_status = None
+        # Number of points already emitted as datums/events, and the number
+        # of points that may be emitted by the current collect() call:
+        self._num_datums = 0
+        self._num_events = 0
+        self._collect_stop = 0
+        # Index of the first frame of the current trajectory in the file, and
+        # of the first frame of the next one (several trajectories can be
+        # flown while staged):
+        self._frame_offset = 0
+        self._next_frame_offset = 0
+        self.plugin_types = {}
+        for detector in self.detectors:
+            if hasattr(detector, 'hdf5'):
+                self.plugin_types[detector.name] = 'hdf5'
+            elif hasattr(detector, 'tiff'):
+                self.plugin_types[detector.name] = 'tiff'
+            else:
+                raise ValueError(f'No hdf5 or tiff plugins were found for {detector.name}')
+        if len(self.plugin_types) != len(self.detectors):
+            raise ValueError('The detectors must have different names')
+        # Two devices on one camera (e.g. vis_eye1 and vis_eye1_tiff) would
+        # both reset its counters and record the same frames:
+        cams = {}
+        for detector in self.detectors:
+            key = detector.cam.prefix or id(detector.cam)
+            if key in cams:
+                raise ValueError(f'{cams[key]} and {detector.name} share the camera '
+                                 f'{detector.cam.prefix or detector.cam.name}')
+            cams[key] = detector.name
+        self.plugin_type = self.plugin_types[self.detector.name]
+
+    @property
+    def _resource_uid(self):
+        # Resource of the first detector
+        return self._resource_uids.get(self.detector.name)
+
+    def _plugin(self, detector):
+        return getattr(detector, self.plugin_types[detector.name])
+
+    def _map(self, func):
+        """Call ``func(detector)`` for all detectors in parallel."""
+        if len(self.detectors) == 1:
+            return [func(self.detector)]
+        with ThreadPoolExecutor(max_workers=len(self.detectors)) as executor:
+            return list(executor.map(func, self.detectors))
+
+    def _stage_detector(self, detector):
         # This sets a filepath (template for TIFFs) and generates a Resource
         # document in the detector.tiff Device's asset cache.
-        self.detector.is_flying = True
-        self.detector.stage_sigs['cam.image_mode'] = 'Multiple'
-        self.detector.stage_sigs['cam.trigger_mode'] = 'Sync In 2'
-        self.detector.stage()
-        self.detector.cam.acquire.put(1)
+        detector.is_flying = True
+        detector.stage_sigs['cam.image_mode'] = 'Multiple'
+        detector.stage_sigs['cam.trigger_mode'] = 'Sync In 2'
+        # num_capture, the chunks and the flight profile are only added for
+        # this staging; unstage() restores the plugin settings they changed.
+        stage_sigs = OrderedDict(detector.stage_sigs)
+        if (self.plugin_types[detector.name] == 'hdf5' and detector.hdf5.chunk == 'row' and
+                hasattr(self.hxn_stage, 'nx')):
+            # One chunk per row of the trajectory (see configure_hdf5_compression):
+            detector.stage_sigs['hdf5.num_frames_chunks'] = int(self.hxn_stage.nx.get())
+        if self.plugin_types[detector.name] == 'hdf5':
+            # Keep the file open until every frame of the staged session is
+            # written (cam.num_images, see setup_fly_scan):
+            detector.stage_sigs['hdf5.num_capture'] = int(detector.cam.num_images.get())
+        if self.flight_profile:
+            detector.stage_sigs.update(flight_profile_sigs(detector))
+        try:
+            detector.stage()
+        finally:
+            detector.stage_sigs.clear()
+            detector.stage_sigs.update(stage_sigs)
+
+    def _unstage_detector(self, detector):
+        detector.unstage()
+        detector.is_flying = False
+        detector.cam.acquire.put(0)
+
+    def stage(self):
+        # The detectors are staged in parallel; if any of them fails, the
+        # others are unstaged again.
+        errors = [error for error in self._map(_catching(self._stage_detector))
+                  if error is not None]
+        if errors:
+            self._map(_catching(self._unstage_detector))
+            raise errors[0]
+        self._resource_uids = {}
+        self._frame_offset = 0
+        self._next_frame_offset = 0
+        for detector in self.detectors:
+            detector.cam.acquire.put(1)
         # self.detector.tiff.capture.put(1)
 
     def unstage(self):
-        # This sets a filepath (template for TIFFs) and generates a Resource
-        # document in the detector.tiff Device's asset cache.
-        self.detector.unstage()
-        self.detector.is_flying = False
-        self.detector.cam.acquire.put(0)
+        errors = [error for error in self._map(_catching(self._unstage_detector))
+                  if error is not None]
+        if errors:
+            raise errors[0]
 
     def kickoff(self):
         set_scanning.put(1)
@@ -48,19 +168,103 @@ class Flyer:
             return bool(value)
         ready_to_scan  = SubscriptionStatus(scan_in_progress,
                                             is_started)
-        self._traj_info.update({'nx': int(self.hxn_stage.nx.get()),
-                                'ny': int(self.hxn_stage.ny.get()),
-                                'x_start': self.hxn_stage.x_start.get(),
-                                'x_stop': self.hxn_stage.x_stop.get(),
-                                'y_start': self.hxn_stage.y_start.get(),
-                                'y_stop': self.hxn_stage.y_stop.get(),
-                                })
-
-        self._array_size.update({'height': getattr(self.detector, self.plugin_type).array_size.height.get(),
-                                 'width': getattr(self.detector, self.plugin_type).array_size.width.get()})
-
+        self._traj_info = self._read_trajectory()
+
+        for detector in self.detectors:
+            plugin = self._plugin(detector)
+            self._array_size[detector.name] = {'height': plugin.array_size.height.get(),
+                                               'width': plugin.array_size.width.get()}
+
+        self._complete_status = None
+        self._num_datums = 0
+        self._num_events = 0
+        self._collect_stop = 0
+        self._frame_offset = self._next_frame_offset
+        self._next_frame_offset += self._num_points()
+        self._bad_frame_counters = {sig: sig.get()
+                                    for detector in self.detectors
+                                    for sig in self._frame_counters(detector)}
+        self._start_gather()
+        for callback in self.kickoff_callbacks:
+            callback(self)
+
+        # Without gather, the points are timestamped with the predicted time
+        # of their trigger, counted from the start of the program:
+        self._trigger_times = time.time() + self._timing()['trigger_times']
         return ready_to_scan & self.hxn_stage.start_scan.set(1)
 
+    def _frame_counters(self, detector):
+        """Return the dropped and bad frame counters of a detector."""
+        counters = [getattr(self._plugin(detector), 'dropped_arrays', None),
+                    getattr(detector.cam, 'ps_bad_frame_counter', None),  # Prosilica
+                    getattr(detector.cam, 'bad_frame_counter', None)]  # SimCam
+        return [counter for counter in counters if counter is not None]
+
+    def _start_gather(self):
+        self._gathering = False
+        self._gathered = None
+        if self.gather is None:
+            return
+        timing = self._timing()
+        period = self.gather.gather_period(duration=timing['total'],
+                                           pulse_width=timing['pulse_width'])
+        if period is None:
+            print(f'{self.gather.name}: the scan does not fit in the gather buffer, '
+                  f'the positions are computed.')
+            return
+        self.gather.start(period)
+        self._gathering = True
+
+    def _read_gather(self, status):
+        """Upload the gather buffer and decode the triggers (in a thread)."""
+        try:
+            decoded = decode_gather(**self.gather.finish())
+            num_points = self._num_points()
+            if len(decoded['time']) != num_points:
+                print(f'{self.gather.name}: {len(decoded["time"])} triggers gathered for '
+                      f'{num_points} points, the positions are computed.')
+                return
+            x, y = self._positions(0, num_points)
+            gathered = {'x': decoded['enc1'] / PMAC_MYRES,
+                        'y': decoded['enc2'] / PMAC_MYRES,
+                        'time': self.gather.start_time + decoded['time']}
+            # The encoders count from power-up; anchor them to the programmed
+            # positions, which leaves the measured deviation of every point:
+            gathered['x'] -= np.median(gathered['x'] - x)
+            gathered['y'] -= np.median(gathered['y'] - y)
+            self._gathered = gathered
+        except Exception as error:
+            print(f'{self.gather.name}: reading the gather buffer failed ({error!r}), '
+                  f'the positions are computed.')
+        finally:
+            self._gathering = False
+            status._finished()
+
+    def _timing(self):
+        """Return the predicted 'total' duration, 'trigger_period', 'pulse_width'
+        and 'trigger_times' (from the start of the program)."""
+        timing = prog16_timing(trigger_rate=self.hxn_stage.trigger_rate.get(),
+                               trigger_times=True, **self._traj_info)
+        # The compare output is high for a fifth of the step (Q105):
+        return {'total': timing['total'],
+                'trigger_period': timing['trigger_period'],
+                'pulse_width': timing['trigger_period'] / 5,
+                'trigger_times': timing['trigger_times']}
+
+    def _read_trajectory(self):
+        """Return the raster programmed in the HXNStage."""
+        return {'nx': int(self.hxn_stage.nx.get()),
+                'ny': int(self.hxn_stage.ny.get()),
+                'x_start': self.hxn_stage.x_start.get(),
+                'x_stop': self.hxn_stage.x_stop.get(),
+                'y_start': self.hxn_stage.y_start.get(),
+                'y_stop': self.hxn_stage.y_stop.get(),
+                'snake': snake_mode(self.hxn_stage),
+                }
+
+    def _num_points(self):
+        return self._traj_info['nx'] * self._traj_info['ny']
+
     def complete(self):
         # Use whether X in the coordinate system is moving
         # as a proxy for whether the total flyscan is done.
@@ -73,103 +277,498 @@ class Flyer:
 
         x_moving  = SubscriptionStatus(scan_in_progress,
                                        is_done)
-        return x_moving
+        self._complete_status = x_moving
+        status = self._watch_frames(x_moving, self.detector)
+        for detector in self.detectors[1:]:
+            status = status & self._watch_frames(x_moving, detector)
+        if self._gathering:
+            gather_status = DeviceStatus(self.gather)
+            x_moving.add_callback(lambda x_moving: threading.Thread(
+                target=self._read_gather, args=(gather_status,), daemon=True).start())
+            status = status & gather_status
+        return status
+
+    def _mismatch(self, status, message):
+        if self.on_mismatch == 'pause' and self.run_engine is not None:
+            print(f'{message} Pausing at the next checkpoint.')
+            self.run_engine.loop.call_soon_threadsafe(self.run_engine.request_pause, True)
+            return
+        try:
+            status.set_exception(DataMismatch(message))
+        except AttributeError:  # ophyd < 1.5
+            print(message)
+            status._finished(success=False)
+        self._abort_program()
+
+    def _abort_program(self):
+        """Stop the stage and the triggers, if the IOC has the AbortScan record."""
+        abort_scan = self.hxn_stage.abort_scan
+        if not abort_scan.connected:
+            print(f'{abort_scan.name} is not connected; the motion program keeps running.')
+            return
+        try:
+            abort_scan.put(1)
+        except Exception as error:
+            print(f'Aborting the motion program failed: {error!r}')
+
+    def _watch_frames(self, scan_status, detector):
+        """Return a status which fails as soon as frames of ``detector`` are lost.
+
+        The dropped/bad frame counters are monitored during the flight, and
+        once the stage stopped the camera and file plugin counters have to
+        reach the expected number of frames within ``frame_timeout``.
+        """
+        status = DeviceStatus(detector)
+        expected = self._next_frame_offset
+        cids = {}
+        reported = False
+
+        def mismatch(message):
+            nonlocal reported
+            if not reported and not status.done:
+                reported = True
+                self._mismatch(status, message)
+
+        def check_counter(value, obj, **kwargs):
+            lost = value - self._bad_frame_counters[obj]
+            if lost > self.max_dropped_frames:
+                mismatch(f'{obj.name} increased by {lost} during the flight.')
+
+        for sig in self._frame_counters(detector):
+            cids[sig] = sig.subscribe(check_counter)
+
+        def check_frames():
+            deadline = time.monotonic() + self.frame_timeout
+            while True:
+                counts = {'camera': int(detector.cam.array_counter.get()),
+                          self.plugin_types[detector.name]: self._frames_written(detector)}
+                if all(count >= expected for count in counts.values()):
+                    break
+                if time.monotonic() > deadline:
+                    mismatch(f'{detector.name}: expected {expected} frames, got {counts}.')
+                    break
+                time.sleep(0.1)
+            if not status.done:
+                status._finished()
+
+        def scan_done(scan_status):
+            if not scan_status.success:
+                if not status.done:
+                    status._finished(success=False)
+            elif not status.done:
+                threading.Thread(target=check_frames, daemon=True).start()
+
+        def cleanup(status):
+            for sig, cid in cids.items():
+                sig.unsubscribe(cid)
+
+        status.add_callback(cleanup)
+        scan_status.add_callback(scan_done)
+        return status
 
     def describe_collect(self):
-        return {
-            'primary':
-                {'x': {'source': '',
-                       'dtype': 'number',
-                       'shape': [self._traj_info['nx']]},
-                 'y': {'source': '',
-                       'dtype': 'number',
-                       'shape': [self._traj_info['ny']]},
-                 f'{self.detector.name}_image': {'source': '...',
-                           'dtype': 'array',
-                           'shape': [self._array_size['height'],
-                                     self._array_size['width']],
-                           'external': 'FILESTORE:'}
-                 }
-            }
+        description = self._describe_positions()
+        for detector in self.detectors:
+            size = self._array_size[detector.name]
+            description[f'{detector.name}_image'] = {'source': '...',
+                                                     'dtype': 'array',
+                                                     'shape': [size['height'], size['width']],
+                                                     'external': 'FILESTORE:'}
+        return {self.stream_name: description}
+
+    def _describe_positions(self):
+        return {'x': {'source': '',
+                      'dtype': 'number',
+                      'shape': [self._traj_info['nx']]},
+                'y': {'source': '',
+                      'dtype': 'number',
+                      'shape': [self._traj_info['ny']]}}
+
+    def _datum_ids(self, start, stop, detector=None):
+        # Datum ids are derived from the frame number in the file, so they
+        # never need to be stored for the whole scan.
+        resource_uid = self._resource_uids[(detector or self.detector).name]
+        return ['{}/{}'.format(resource_uid, self._frame_offset + i)
+                for i in range(start, stop)]
+
+    def _frames_written(self, detector=None):
+        """Return the number of frames the file plugin has written so far."""
+        detector = detector or self.detector
+        plugin = self._plugin(detector)
+        if self.plugin_types[detector.name] == 'hdf5':
+            return int(plugin.num_captured.get())
+        return int(plugin.array_counter.get())
+
+    def _points_ready(self):
+        num_points = self._num_points()
+        if self._gathering:
+            # The measured positions are only known after the flight.
+            return 0
+        if self._complete_status is not None and self._complete_status.done:
+            return num_points
+        # The scan is still running: only the frames which are already on
+        # disk for every detector can be published.
+        written = min(self._frames_written(detector) for detector in self.detectors)
+        return max(0, min(written - self._frame_offset, num_points))
 
     def collect_asset_docs(self):
-        asset_docs_cache = []
-
-        # Get the Resource which was produced when the detector was staged.
-        (name, resource), = getattr(self.detector, self.plugin_type).collect_asset_docs()
-
-        assert name == 'resource'
-        asset_docs_cache.append(('resource', resource))
-        self._datum_ids.clear()
-        # Generate Datum documents from scratch here, because the detector was
-        # triggered externally by the DeltaTau, never by ophyd.
-        resource_uid = resource['uid']
-        num_points = self._traj_info['nx'] * self._traj_info['ny']
-        for i in range(num_points):
-            datum_id = '{}/{}'.format(resource_uid, i)
-            self._datum_ids.append(datum_id)
-            datum = {'resource': resource_uid,
-                     'datum_id': datum_id,
-                     'datum_kwargs': {'point_number': i}}
-            asset_docs_cache.append(('datum', datum))
-        return tuple(asset_docs_cache)
+        # Get the Resources which were produced when the detectors were
+        # staged. They are only available from the first call after staging.
+        for detector in self.detectors:
+            for name, resource in self._plugin(detector).collect_asset_docs():
+                assert name == 'resource'
+                self._resource_uids[detector.name] = resource['uid']
+                yield 'resource', resource
+
+        # Generate Datum documents from scratch here, because the detectors
+        # were triggered externally by the DeltaTau, never by ophyd. Only one
+        # page of datum ids is held in memory at a time.
+        self._collect_stop = self._points_ready()
+        for start in range(self._num_datums, self._collect_stop, self.page_size):
+            stop = min(start + self.page_size, self._collect_stop)
+            self._num_datums = stop
+            point_numbers = range(self._frame_offset + start, self._frame_offset + stop)
+            for detector in self.detectors:
+                resource_uid = self._resource_uids[detector.name]
+                datum_ids = self._datum_ids(start, stop, detector)
+                if self.datum_pages:
+                    yield 'datum_page', {'resource': resource_uid,
+                                         'datum_id': datum_ids,
+                                         'datum_kwargs': {'point_number': list(point_numbers)}}
+                else:
+                    for i, datum_id in zip(point_numbers, datum_ids):
+                        yield 'datum', {'resource': resource_uid,
+                                        'datum_id': datum_id,
+                                        'datum_kwargs': {'point_number': i}}
+
+    def _positions(self, start, stop):
+        """Return the x and y positions of the points ``start:stop``.
+
+        The positions are computed with NumPy for the whole slice at once
+        instead of walking the raster point by point.
+        """
+        return raster_positions(start=start, stop=stop, **self._traj_info)
+
+    def _event_pages(self, page_size):
+        image_keys = {detector.name: f'{detector.name}_image' for detector in self.detectors}
+        for start in range(self._num_events, self._collect_stop, page_size):
+            stop = min(start + page_size, self._collect_stop)
+            self._num_events = stop
+            if self._gathered is not None:
+                x = self._gathered['x'][start:stop]
+                y = self._gathered['y'][start:stop]
+                ts = self._gathered['time'][start:stop].tolist()
+            else:
+                x, y = self._positions(start, stop)
+                ts = self._trigger_times[start:stop].tolist()
+            data = {'x': x.tolist(), 'y': y.tolist()}
+            for detector in self.detectors:
+                data[image_keys[detector.name]] = self._datum_ids(start, stop, detector)
+            yield {
+                'data': data,
+                'timestamps': {key: ts for key in data},
+                'time': ts,
+                'seq_num': list(range(start + 1, stop + 1)),
+                'filled': {key: [False] * (stop - start) for key in image_keys.values()}}
+
+    def collect_pages(self):
+        """Yield event pages of up to ``self.page_size`` points.
+
+        Only the points which were not emitted by a previous call and
+        whose datums have been generated by collect_asset_docs() are
+        emitted, so it can be called repeatedly during the flight.
+
+        The RunEngines this runs on (bluesky 1.8 to 1.10) never call it:
+        they use collect(), which emits the same points one event at a
+        time. It is there for consumers which take event pages directly.
+        Set ``page_size`` to 1 to get one event per page.
+        """
+        assert self._resource_uid is not None, 'collect_asset_docs() must be called first'
+        yield from self._event_pages(self.page_size)
 
     def collect(self):
-        assert len(self._datum_ids) == self._traj_info['nx'] * self._traj_info['ny']
-
-        nx = self._traj_info['nx']
-        x_start = self._traj_info['x_start']
-        x_stop = self._traj_info['x_stop']
-
-        ny = self._traj_info['ny']
-        y_start = self._traj_info['y_start']
-        y_stop = self._traj_info['y_stop']
-
-        i = 0
-        # y is a slow axis
-        for y in np.linspace(y_start, y_stop, ny):
-            # x is a fast axis
-            for x in np.linspace(x_start, x_stop, nx):
-                datum_id = self._datum_ids[i]
-                i += 1
-                now = time.time()
+        """Yield one event per new point; this is what the RunEngine calls."""
+        assert self._resource_uid is not None, 'collect_asset_docs() must be called first'
+
+        for page in self._event_pages(self.page_size):
+            for i, seq_num in enumerate(page['seq_num']):
+                t = page['time'][i]
                 yield {
-                    'data': {
-                        'x': x,
-                        'y': y,
-                        f'{self.detector.name}_image': datum_id},
-                    'timestamps': {
-                        'x': now,
-                        'y': now,
-                        f'{self.detector.name}_image': now},
-                    'time': now,
-                    'seq_num': i,
-                    'filled': {f'{self.detector.name}_image': False}}
+                    'data': {key: values[i] for key, values in page['data'].items()},
+                    'timestamps': {key: t for key in page['data']},
+                    'time': t,
+                    'seq_num': seq_num,
+                    'filled': {key: False for key in page['filled']}}
+
+    def stream(self, stream_name):
+        """Return a FlyerStream which flies this flyer into ``stream_name``."""
+        return FlyerStream(self, stream_name)
+
+
+class FlyerStream:
+    """A flyer seen as the source of one event stream.
+
+    The RunEngine describes what an object collects only once per run, so
+    flights of one staged flyer into several streams (tomo_fly_scan,
+    fly_regions) are kicked off, completed and collected through one of
+    these per stream. The flyer itself is staged.
+    """
+    def __init__(self, flyer, stream_name):
+        self.flyer = flyer
+        self.stream_name = stream_name
+        self.name = f'{flyer.name}_{stream_name}'
+        self.parent = None
+
+    def __getattr__(self, attr):
+        return getattr(self.flyer, attr)
+
+    def kickoff(self):
+        self.flyer.stream_name = self.stream_name
+        return self.flyer.kickoff()
+
+    def complete(self):
+        return self.flyer.complete()
+
+    def describe_collect(self):
+        return {self.stream_name: self.flyer.describe_collect()[self.flyer.stream_name]}
+
+    def collect_asset_docs(self):
+        return self.flyer.collect_asset_docs()
+
+    def collect_pages(self):
+        return self.flyer.collect_pages()
+
+    def collect(self):
+        return self.flyer.collect()
+
+
+def _catching(func):
+    """Wrap ``func`` to return its exception (or None) instead of raising."""
+    def wrapper(arg):
+        try:
+            func(arg)
+        except Exception as error:
+            return error
+    return wrapper
 
 
 class HXNStage(Device):
-    x_start = Component(EpicsSignal, 'XStart-RB', write_pv='XStart')
-    x_stop = Component(EpicsSignal, 'XStop-RB', write_pv='XStop')
-    nx = Component(EpicsSignal, 'NX-RB', write_pv='NX')
-    y_start = Component(EpicsSignal, 'YStart-RB', write_pv='YStart')
-    y_stop = Component(EpicsSignal, 'YStop-RB', write_pv='YStop')
-    ny = Component(EpicsSignal, 'NY-RB', write_pv='NY')
-    trigger_rate = Component(EpicsSignal, 'TriggerRate-RB', write_pv='TriggerRate')
+    # The tolerances let set() finish as soon as the readback matches:
+    x_start = Component(EpicsSignal, 'XStart-RB', write_pv='XStart', tolerance=1e-6)
+    x_stop = Component(EpicsSignal, 'XStop-RB', write_pv='XStop', tolerance=1e-6)
+    nx = Component(EpicsSignal, 'NX-RB', write_pv='NX', tolerance=0)
+    y_start = Component(EpicsSignal, 'YStart-RB', write_pv='YStart', tolerance=1e-6)
+    y_stop = Component(EpicsSignal, 'YStop-RB', write_pv='YStop', tolerance=1e-6)
+    ny = Component(EpicsSignal, 'NY-RB', write_pv='NY', tolerance=0)
+    trigger_rate = Component(EpicsSignal, 'TriggerRate-RB', write_pv='TriggerRate', tolerance=1e-6)
+    snake = Component(EpicsSignal, 'Snake-RB', write_pv='Snake', tolerance=0)
     start_scan = Component(EpicsSignal, 'StartScan.PROC')
+    # PLC 18, which aborts PROG16 or PROG17 (pending the AbortScan record
+    # in the IOC, see Flyer._abort_program):
+    abort_scan = Component(EpicsSignal, 'AbortScan.PROC')
 
 
 # Objects for the scan
-set_scanning = EpicsSignal('XF:03IDC-CT{MC:01}SetScanning', name='set_scanning')
-scan_in_progress = EpicsSignal('XF:03IDC-CT{MC:01}ScanInProgress', name='scan_in_progress')
-hxn_stage = HXNStage('XF:03IDC-CT{MC:01}', name='hxn_stage')
-flyer = Flyer(vis_eye1, hxn_stage)
+if SIMULATION:
+    set_scanning = Signal(name='set_scanning', value=0)
+    scan_in_progress = Signal(name='scan_in_progress', value=0)
+    hxn_stage = SimHXNStage(name='hxn_stage', camera=vis_eye1,
+                            scan_in_progress=scan_in_progress)
+else:
+    set_scanning = EpicsSignal('XF:03IDC-CT{MC:01}SetScanning', name='set_scanning')
+    scan_in_progress = EpicsSignal('XF:03IDC-CT{MC:01}ScanInProgress', name='scan_in_progress')
+    hxn_stage = HXNStage('XF:03IDC-CT{MC:01}', name='hxn_stage')
+# Built on first use in a lazy startup, as it connects the camera:
+flyer = lazy_device(lambda: Flyer(vis_eye1, hxn_stage, run_engine=RE))
 
 
 class DataMismatch(Exception):
     ...
 
 
-def fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time, trigger_rate=7, md={}):
+class SetupMismatch(Exception):
+    ...
+
+
+def fly_live(flyer, *, poll_period=1.0, md=None):
+    """Like bp.fly, but publish the points already written during the flight.
+
+    The flyer is collected every ``poll_period`` seconds while the PMAC is
+    still scanning, so only the last partial chunk is left at the end.
+
+    Parameters
+    ----------
+    flyer : Flyer
+        the flyer to kick off, complete and collect
+    poll_period : float, optional
+        time between the intermediate collections in seconds
+    md : dict, optional
+        metadata
+    """
+    if flyer.gather is not None:
+        # The gathered positions are only known once the flight is over.
+        raise ValueError('fly_live cannot publish points while gathering; '
+                         'set flyer.gather = None')
+
+    @bpp.run_decorator(md=md)
+    def _fly_live():
+        yield from bps.kickoff(flyer, wait=True)
+        status = yield from bps.complete(flyer, group='fly_live', wait=False)
+        while not status.done:
+            yield from bps.collect(flyer)
+            yield from bps.sleep(poll_period)
+        # Raise if the flight failed:
+        yield from bps.wait(group='fly_live')
+        yield from bps.collect(flyer)
+        # A frame watchdog pause (Flyer.on_mismatch='pause') stops here.
+        yield from bps.checkpoint()
+
+    return (yield from _fly_live())
+
+
+def fly_collect(flyer, *, md=None):
+    """Like bp.fly for one flyer, with a checkpoint after the collection.
+
+    A frame watchdog pause (Flyer.on_mismatch='pause') stops there, with
+    the points of the flight published: resume to close the run, or abort
+    it.
+    """
+    @bpp.run_decorator(md=md)
+    def _fly_collect():
+        yield from bps.kickoff(flyer, wait=True)
+        yield from bps.complete(flyer, wait=True)
+        yield from bps.collect(flyer)
+        yield from bps.checkpoint()
+
+    return (yield from _fly_collect())
+
+
+def gather_wrapper(plan, flyer, gather):
+    """Run ``plan`` with ``flyer.gather`` set to ``gather``, then restore it."""
+    previous = flyer.gather
+
+    def set_gather():
+        flyer.gather = gather
+        return (yield from plan)
+
+    def restore():
+        flyer.gather = previous
+        yield from bps.null()
+
+    return (yield from bpp.finalize_wrapper(set_gather(), restore()))
+
+
+def _set_and_confirm(*args, timeout):
+    """Set signals in parallel and check every readback against its setpoint.
+
+    Each ``set`` finishes as soon as the readback of the signal matches the
+    setpoint. SetupMismatch is raised if any of them does not within
+    ``timeout`` seconds.
+    """
+    pairs = list(zip(args[::2], args[1::2]))
+    for signal, value in pairs:
+        yield from bps.abs_set(signal, value, group='set_and_confirm', timeout=timeout)
+    try:
+        yield from bps.wait(group='set_and_confirm')
+    except FailedStatus:
+        mismatches = []
+        for signal, value in pairs:
+            reading = yield from bps.read(signal)
+            readback = reading[signal.name]['value']
+            if (np.shape(readback) != np.shape(value) or
+                    not np.allclose(readback, value, rtol=0, atol=signal.tolerance or 0)):
+                mismatches.append(f'{signal.name}: set {value!r}, readback {readback!r}')
+        raise SetupMismatch(f'Readbacks did not match the setpoints within {timeout} s:\n' +
+                            '\n'.join(mismatches))
+
+
+def _trajectory_setpoints(*, x_start, x_stop, nx, y_start, y_stop, ny,
+                          trigger_rate, snake):
+    return [
+        # X motor:
+        flyer.hxn_stage.x_start, x_start,
+        flyer.hxn_stage.x_stop, x_stop,
+        flyer.hxn_stage.nx, nx,
+
+        # Y motor:
+        flyer.hxn_stage.y_start, y_start,
+        flyer.hxn_stage.y_stop, y_stop,
+        flyer.hxn_stage.ny, ny,
+
+        # Trigger rate:
+        flyer.hxn_stage.trigger_rate, trigger_rate,
+    ] + _snake_setpoints(flyer.hxn_stage, snake)
+
+
+def snake_mode(hxn_stage):
+    """Return the row direction mode (P1608) of the HXNStage.
+
+    IOCs without the Snake record always scan the rows in +X.
+    """
+    if not hxn_stage.snake.connected:
+        return False
+    return bool(hxn_stage.snake.get())
+
+
+def _snake_setpoints(hxn_stage, snake):
+    # The Snake record is only needed for snake scans; without it, P1608
+    # keeps its default of 0 (see PLC20_SetupScan.pmc).
+    if snake or hxn_stage.snake.connected:
+        return [hxn_stage.snake, int(snake)]
+    return []
+
+
+def _camera_setpoints(flyer, *, exp_time, num_images):
+    setpoints = []
+    for detector in flyer.detectors:
+        setpoints += [detector.cam.acquire_time, exp_time,
+                      detector.cam.num_images, num_images]
+    return setpoints
+
+
+def setup_trajectory(*, x_start, x_stop, nx, y_start, y_stop, ny,
+                     trigger_rate=7, snake=False, timeout=5.0):
+    """Program only the HXNStage trajectory, leaving the camera alone.
+
+    This can be used between two trajectories flown while the flyer is
+    staged (see fly_regions).
+    """
+    yield from _set_and_confirm(
+        *_trajectory_setpoints(x_start=x_start, x_stop=x_stop, nx=nx,
+                               y_start=y_start, y_stop=y_stop, ny=ny,
+                               trigger_rate=trigger_rate, snake=snake),
+        timeout=timeout)
+    print(f'{flyer.hxn_stage.name}: x={x_start}..{x_stop} ({nx}), '
+          f'y={y_start}..{y_stop} ({ny}), trigger_rate={trigger_rate}, '
+          f'snake={bool(snake)}')
+
+
+def setup_fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time,
+                   trigger_rate=7, snake=False, num_images=None, timeout=5.0):
+    """Program the HXNStage trajectory and the camera for a fly scan.
+
+    The parameters are the same as for fly_scan. ``num_images`` is the
+    number of frames the camera (and the file plugin) will acquire while
+    staged; it defaults to ``nx * ny``. The setup is done as soon as all
+    readbacks match their setpoints, or fails with SetupMismatch after
+    ``timeout`` seconds.
+    """
+    if num_images is None:
+        num_images = nx * ny
+
+    setpoints = _trajectory_setpoints(x_start=x_start, x_stop=x_stop, nx=nx,
+                                      y_start=y_start, y_stop=y_stop, ny=ny,
+                                      trigger_rate=trigger_rate, snake=snake)
+    setpoints += _camera_setpoints(flyer, exp_time=exp_time, num_images=num_images)
+
+    yield from _set_and_confirm(*setpoints, timeout=timeout)
+    print(f'{flyer.hxn_stage.name}: x={x_start}..{x_stop} ({nx}), '
+          f'y={y_start}..{y_stop} ({ny}), trigger_rate={trigger_rate}, '
+          f'snake={bool(snake)}; exp_time={exp_time}, num_images={num_images}')
+
+
+def fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time, trigger_rate=7,
+             snake=False, live=False, check=True, gather=None, md={}):
     """Fly scan plan with a stage (X and Y motors) and a camera.
 
     How to run:
@@ -177,6 +776,11 @@ def fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time, trigger_rate
     RE(fly_scan(x_start=0, x_stop=0.1, nx=50, y_start=0, y_stop=0.1, ny=4,
                 exp_time=0.01, trigger_rate=5))
 
+    The predicted duration of every phase is printed, without touching the
+    hardware, by
+    print_estimate(estimate_fly_scan(x_start=0, x_stop=0.1, nx=50, y_start=0, y_stop=0.1,
+                                     ny=4, exp_time=0.01, trigger_rate=5))
+
     Parameters
     ----------
     x_start : float
@@ -193,46 +797,133 @@ def fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time, trigger_rate
         number of points for the Y-motor
     exp_time : float
         exposure time of the camera
-    trigger_rate : integer, optional
-        trigger rate of the camera
+    trigger_rate : integer or 'max', optional
+        trigger rate of the camera; 'max' uses the fastest safe rate
+        (see plan_fly_scan)
+    snake : bool, optional
+        scan alternate rows in the opposite X direction instead of returning
+        to x_start before every row
+    live : bool, optional
+        publish the collected points while the stage is still moving
+        (see fly_live)
+    check : bool, optional
+        refuse a trigger rate which is faster than the camera can take
+        frames or than the stage can move
+    gather : PMACGather, optional
+        record the measured position and time of every trigger (e.g.
+        hxn_gather, see 23-gather.py); the points are then published once
+        the flight is over, so it cannot be combined with ``live``
     md : dict, optional
         metadata
     """
-
-    yield from bps.mv(
-        # X motor:
-        flyer.hxn_stage.x_start, x_start,
-        flyer.hxn_stage.x_stop, x_stop,
-        flyer.hxn_stage.nx, nx,
-
-        # Y motor:
-        flyer.hxn_stage.y_start, y_start,
-        flyer.hxn_stage.y_stop, y_stop,
-        flyer.hxn_stage.ny, ny,
-
-        # Trigger rate:
-        flyer.hxn_stage.trigger_rate, trigger_rate,
-    )
-
-    yield from bps.sleep(1.0)
-    for c in flyer.hxn_stage.component_names:
-        print(f'{getattr(flyer.hxn_stage, c).read()}')
-
-    yield from bps.mv(flyer.detector.cam.acquire_time, exp_time)
-    yield from bps.mv(flyer.detector.cam.num_images,
-        int(flyer.hxn_stage.nx.get()) * int(flyer.hxn_stage.ny.get())
-    )
+    if live and gather is not None:
+        raise ValueError('live=True publishes the points during the flight, '
+                         'which a gather does not allow')
+    if trigger_rate == 'max' or check:
+        plan = plan_fly_scan(x_start=x_start, x_stop=x_stop, nx=nx,
+                             y_start=y_start, y_stop=y_stop, ny=ny, exp_time=exp_time,
+                             trigger_rate=None if trigger_rate == 'max' else trigger_rate,
+                             snake=snake, adjust=False)
+        trigger_rate = plan['settings']['trigger_rate']
+    estimate = estimate_fly_scan(x_start=x_start, x_stop=x_stop, nx=nx,
+                                 y_start=y_start, y_stop=y_stop, ny=ny, exp_time=exp_time,
+                                 trigger_rate=trigger_rate, snake=snake, live=live)
+    print(f'Predicted scan time: {estimate["total"]:.1f} s')
+    # Compared with the achieved times by plan_profiler:
+    _md = {'predicted_phases': estimate['phases']}
+    _md.update(md)
+
+    yield from setup_fly_scan(x_start=x_start, x_stop=x_stop, nx=nx,
+                              y_start=y_start, y_stop=y_stop, ny=ny,
+                              exp_time=exp_time, trigger_rate=trigger_rate,
+                              snake=snake)
 
     # md.update({'x_start': x_start, 'x_stop': x_stop, 'nx': nx,
     #            'y_start': y_start, 'y_stop': y_stop, 'ny': nx,
     #            'exp_time': exp_time, 'trigger_rate': trigger_rate,
     #            })
 
-    yield from bps.sleep(1.0)
-
     @bpp.stage_decorator([flyer])
     def _fly_scan():
-        yield from bp.fly([flyer])
+        if live:
+            yield from fly_live(flyer, md=_md)
+        else:
+            yield from fly_collect(flyer, md=_md)
+
+    yield from gather_wrapper(_fly_scan(), flyer, gather)
 
-    yield from _fly_scan()
 
+def fly_regions(regions, *, exp_time, trigger_rate=7, snake=False, check=True,
+                md=None):
+    """Fly several regions in one run, with the camera armed throughout.
+
+    The flyer is staged once, so the camera keeps acquiring and all frames
+    go to a single HDF5 file. Only the HXNStage trajectory is reprogrammed
+    between the regions. The points of region ``i`` go to the stream
+    ``region_NNN``, and their datums point at that region's frames in the
+    shared file.
+
+    How to run:
+    -----------
+    RE(fly_regions([dict(x_start=0, x_stop=0.1, nx=20, y_start=0, y_stop=0.1, ny=20),
+                    dict(x_start=0.5, x_stop=0.6, nx=20, y_start=0, y_stop=0.1, ny=20,
+                         trigger_rate=5)],
+                   exp_time=0.01))
+
+    Parameters
+    ----------
+    regions : list of dict
+        x_start, x_stop, nx, y_start, y_stop and ny of each region, as for
+        fly_scan; 'trigger_rate' and 'snake' may be given per region
+    exp_time : float
+        exposure time of the camera, the same for all regions
+    trigger_rate : integer, optional
+        trigger rate of the regions which do not give their own
+    snake : bool, optional
+        row direction of the regions which do not give their own
+    check : bool, optional
+        refuse a trigger rate which is faster than the camera can take
+        frames or than the stage can move, before anything is moved
+    md : dict, optional
+        metadata
+    """
+    regions = [{'trigger_rate': trigger_rate, 'snake': snake, **region}
+               for region in regions]
+    if not regions:
+        raise ValueError('No regions to scan')
+    if check:
+        scan_time = 0
+        for region in regions:
+            scan_time += plan_fly_scan(exp_time=exp_time, adjust=False, **region)['scan_time']
+        print(f'Predicted scan time: {scan_time:.1f} s for {len(regions)} regions')
+    streams = [f'region_{i:03d}' for i in range(len(regions))]
+    _md = {'plan_name': 'fly_regions',
+           'regions': regions,
+           'streams': streams}
+    _md.update(md or {})
+
+    yield from setup_fly_scan(exp_time=exp_time,
+                              num_images=sum(r['nx'] * r['ny'] for r in regions),
+                              **regions[0])
+
+    def reset_stream_name():
+        flyer.stream_name = 'primary'
+        yield from bps.null()
+
+    @bpp.stage_decorator([flyer])
+    @bpp.run_decorator(md=_md)
+    def _fly_regions():
+        for i, (region, stream_name) in enumerate(zip(regions, streams)):
+            # A frame watchdog pause (Flyer.on_mismatch='pause') stops here.
+            yield from bps.checkpoint()
+            if i:
+                yield from setup_trajectory(**region)
+            region_flyer = flyer.stream(stream_name)
+            yield from bps.kickoff(region_flyer, wait=True)
+            yield from bps.complete(region_flyer, wait=True)
+            yield from bps.collect(region_flyer)
+
+    yield from bpp.finalize_wrapper(_fly_regions(), reset_stream_name())
+
+
+startup_timer.mark('20-flyer.py')
@@ -0,0 +1,190 @@
+# Choose fly scan settings from the PROG16 timing model (06-timing.py).
+
+# Time the camera needs between the end of an exposure and the next
+# trigger. This depends on the camera model and ROI; measure it for the
+# configuration in use.
+CAMERA_READOUT_TIME = 0.002
+
+
+def max_trigger_rate(*, x_start, x_stop, nx, exp_time,
+                     readout_time=CAMERA_READOUT_TIME, margin=1.0):
+    """Return the highest trigger rate for a row and what limits it.
+
+    PROG16 programs a feedrate of ``(x_stop - x_start) / nx * trigger_rate``
+    while the points are ``(x_stop - x_start) / (nx - 1)`` apart, and the
+    feedrate is capped by I116. Returns a ``(rate, limited_by)`` tuple, with
+    ``limited_by`` either 'camera' or 'motor'.
+    """
+    width = abs(x_stop - x_start)
+    # Trigger period = nx / ((nx - 1) * trigger_rate) >= exp_time + readout_time:
+    camera_limit = nx / (max(nx - 1, 1) * (exp_time + readout_time))
+    motor_limit = PMAC_MAX_SPEED * nx / width if width else np.inf
+    if camera_limit <= motor_limit:
+        return margin * camera_limit, 'camera'
+    return margin * motor_limit, 'motor'
+
+
+def plan_fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time,
+                  trigger_rate=None, snake=False, readout_time=CAMERA_READOUT_TIME,
+                  margin=0.95, integer_rate=True, adjust=True):
+    """Find the fastest safe trigger rate and predict the scan time.
+
+    How to run:
+    -----------
+    plan = plan_fly_scan(x_start=0, x_stop=0.1, nx=50, y_start=0, y_stop=0.1,
+                         ny=4, exp_time=0.01)
+    RE(fly_scan(**plan['settings']))
+
+    Parameters
+    ----------
+    x_start, x_stop, nx, y_start, y_stop, ny, exp_time, snake :
+        as for fly_scan
+    trigger_rate : float, optional
+        the requested trigger rate; by default the fastest safe one is used
+    readout_time : float, optional
+        camera time needed between an exposure and the next trigger
+    margin : float, optional
+        fraction of the limiting rate used when choosing the rate
+    integer_rate : bool, optional
+        round the chosen rate down to an integer
+    adjust : bool, optional
+        lower a requested rate which would drop frames or exceed the
+        motor speed, instead of raising ValueError
+
+    Returns
+    -------
+    dict with the 'settings' for fly_scan, the 'max_trigger_rate', what it
+    is 'limited_by', the 'trigger_period', the predicted 'scan_time' and the
+    duration of each PMAC program phase in 'phases' (all times in seconds)
+    """
+    if nx < 2 or ny < 1:
+        raise ValueError('A fly scan needs nx >= 2 and ny >= 1')
+    limit, limited_by = max_trigger_rate(x_start=x_start, x_stop=x_stop, nx=nx,
+                                         exp_time=exp_time, readout_time=readout_time)
+    if trigger_rate is None:
+        trigger_rate = margin * limit
+        if integer_rate:
+            trigger_rate = np.floor(trigger_rate)
+        if trigger_rate <= 0:
+            raise ValueError(f'No trigger rate is fast enough for exp_time={exp_time} '
+                             f'(limit {limit:.3f} Hz)')
+    elif trigger_rate > limit:
+        message = (f'trigger_rate={trigger_rate} is above the {limited_by} limit '
+                   f'of {limit:.3f} Hz')
+        if not adjust:
+            raise ValueError(message)
+        trigger_rate = np.floor(limit) if integer_rate else limit
+        print(f'{message}; using {trigger_rate}.')
+
+    settings = {'x_start': x_start, 'x_stop': x_stop, 'nx': nx,
+                'y_start': y_start, 'y_stop': y_stop, 'ny': ny,
+                'exp_time': exp_time, 'trigger_rate': trigger_rate,
+                'snake': snake}
+    timing = prog16_timing(x_start=x_start, x_stop=x_stop, nx=nx,
+                           y_start=y_start, y_stop=y_stop, ny=ny,
+                           trigger_rate=trigger_rate, snake=snake)
+    return {'settings': settings,
+            'max_trigger_rate': limit,
+            'limited_by': limited_by,
+            'trigger_period': timing['trigger_period'],
+            'scan_time': timing['total'],
+            'phases': timing['phases']}
+
+
+
+def measure_max_trigger_rate(*, x_start, x_stop, nx, y_start, y_stop, ny=2,
+                             exp_time, low=1, high=None, repeats=2, resolution=1,
+                             timeout=5.0):
+    """Find the highest trigger rate the camera sustains without losing frames.
+
+    Short fly scans of the given region are flown at the rates of a binary
+    search between ``low`` and ``high`` (by default the motor limit, or the
+    camera limit without any readout time). A rate passes if ``repeats``
+    flights in a row finish with the flyer's frame watchdog satisfied, i.e.
+    without dropped or bad frames. Each tried rate is flown in a run of its
+    own (kickoff and complete need one) which holds no events. The flyer is
+    staged as for fly_scan, so its flight profile is what gets measured.
+
+    How to run:
+    -----------
+    RE(measure_max_trigger_rate(x_start=0, x_stop=0.1, nx=50, y_start=0,
+                                y_stop=0.01, exp_time=0.01))
+
+    Returns
+    -------
+    dict with the highest passing 'trigger_rate', the 'trigger_period' and
+    the 'readout_time' it implies (usable as CAMERA_READOUT_TIME), and the
+    outcome of every tried rate in 'tried'
+    """
+    if high is None:
+        high, _ = max_trigger_rate(x_start=x_start, x_stop=x_stop, nx=nx,
+                                   exp_time=exp_time, readout_time=0)
+    region = {'x_start': x_start, 'x_stop': x_stop, 'nx': nx,
+              'y_start': y_start, 'y_stop': y_stop, 'ny': ny}
+    on_mismatch = flyer.on_mismatch
+    tried = {}
+
+    def passes(rate):
+        yield from setup_fly_scan(exp_time=exp_time, trigger_rate=rate,
+                                  num_images=nx * ny * repeats, timeout=timeout,
+                                  **region)
+
+        @bpp.stage_decorator([flyer])
+        @bpp.run_decorator(md={'plan_name': 'measure_max_trigger_rate',
+                               'trigger_rate': rate, 'exp_time': exp_time, **region})
+        def flights():
+            for _ in range(repeats):
+                yield from bps.kickoff(flyer, wait=True)
+                yield from bps.complete(flyer, wait=True)
+
+        try:
+            yield from flights()
+        except FailedStatus:
+            return False
+        return True
+
+    def quantize(rate):
+        return float(np.floor(rate / resolution) * resolution)
+
+    def attempt(rate):
+        ok = yield from passes(rate)
+        tried[rate] = ok
+        print(f'trigger_rate={rate}: {"ok" if ok else "frames lost"}')
+        return ok
+
+    def search():
+        # The rate at ``lo`` passed and the one at ``hi`` failed:
+        hi = quantize(high)
+        if (yield from attempt(hi)):
+            return hi
+        lo = quantize(low)
+        if lo >= hi or not (yield from attempt(lo)):
+            return None
+        while True:
+            mid = quantize((lo + hi) / 2)
+            if mid <= lo:
+                return lo
+            if (yield from attempt(mid)):
+                lo = mid
+            else:
+                hi = mid
+
+    def restore():
+        flyer.on_mismatch = on_mismatch
+        yield from bps.null()
+
+    flyer.on_mismatch = 'raise'
+    best = yield from bpp.finalize_wrapper(search(), restore())
+    if best is None:
+        raise RuntimeError(f'Frames were lost at every rate tried: {tried}')
+    period = prog16_timing(trigger_rate=best, **region)['trigger_period']
+    result = {'trigger_rate': best,
+              'trigger_period': period,
+              'readout_time': period - exp_time,
+              'tried': tried}
+    print(f'Highest sustainable trigger rate: {best} Hz '
+          f'(period {period:.4f} s, readout time {period - exp_time:.4f} s)')
+    return result
+
+
+startup_timer.mark('21-planner.py')
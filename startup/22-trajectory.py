@@ -0,0 +1,254 @@
+# Fly scans along arbitrary trajectories (pmc/PROG17_Trajectory.pmc).
+#
+# The points are computed with NumPy, uploaded to the PMAC as a position
+# table and visited at a fixed trigger rate, so spirals and Fermat spirals
+# run at fly scan speed instead of as step scans (see 90-plans.py).
+
+
+def spiral_points(*, x_center, y_center, x_range, y_range, dr, nth, dr_y=None, tilt=0.0):
+    """Return the points of an Archimedean spiral clipped to a rectangle.
+
+    Same pattern as bluesky.plans.spiral: ring ``i`` has radius ``i * dr``
+    and ``i * nth`` points; ``dr_y`` stretches it in Y, ``tilt`` (rad)
+    shears the rectangle.
+    """
+    aspect = 1.0 if dr_y is None else dr_y / dr
+    half_x = x_range / 2
+    half_y = y_range / (2 * aspect)
+    num_rings = 1 + int(np.hypot(half_x, half_y) / dr)
+    rings = np.repeat(np.arange(1, num_rings + 2), np.arange(1, num_rings + 2) * nth)
+    # Position of every point in its ring:
+    first = np.concatenate([[0], np.cumsum(np.arange(1, num_rings + 2) * nth)[:-1]])
+    index = np.arange(len(rings)) - np.repeat(first, np.arange(1, num_rings + 2) * nth)
+    angle = 2 * np.pi * index / (rings * nth)
+    x = rings * dr * np.cos(angle)
+    y = rings * dr * np.sin(angle) * aspect
+    inside = ((np.abs(x - (y / aspect) / np.tan(tilt + np.pi / 2)) <= half_x) &
+              (np.abs(y / aspect) <= half_y))
+    return x_center + x[inside], y_center + y[inside]
+
+
+def fermat_points(*, x_center, y_center, x_range, y_range, dr, factor=1.0, tilt=0.0):
+    """Return the points of a Fermat spiral clipped to a rectangle.
+
+    Point ``k`` is at radius ``dr * factor * sqrt(k)`` and angle ``k``
+    times the golden angle, which fills the rectangle with a nearly
+    uniform density.
+    """
+    half_x = x_range / 2
+    half_y = y_range / 2
+    num_points = int(np.ceil((np.hypot(half_x, half_y) / (dr * factor)) ** 2))
+    k = np.arange(1, num_points + 1)
+    radius = dr * factor * np.sqrt(k)
+    angle = k * np.deg2rad(137.508)
+    x = radius * np.cos(angle)
+    y = radius * np.sin(angle)
+    inside = ((np.abs(x - y / np.tan(tilt + np.pi / 2)) <= half_x) &
+              (np.abs(y) <= half_y))
+    return x_center + x[inside], y_center + y[inside]
+
+
+def spiral_square_points(*, x_center, y_center, x_range, y_range, x_num, y_num):
+    """Return the points of an ``x_num`` by ``y_num`` grid, ring by ring.
+
+    Like bluesky.plans.spiral_square, the grid is visited from its center
+    outwards, one square ring after the other.
+    """
+    col, row = np.meshgrid(np.arange(x_num) - (x_num - 1) / 2,
+                           np.arange(y_num) - (y_num - 1) / 2)
+    col, row = col.ravel(), row.ravel()
+    ring = np.maximum(np.abs(col), np.abs(row))
+    angle = np.mod(np.arctan2(row, col), 2 * np.pi)
+    order = np.lexsort((angle, ring))
+    x = x_center + col[order] * x_range / max(x_num - 1, 1)
+    y = y_center + row[order] * y_range / max(y_num - 1, 1)
+    return x, y
+
+
+class HXNTrajectory(Device):
+    """Point table and trigger rate of PROG17, and the PLC which runs it."""
+    # P2000..P4999 and P5000..P7999, in mm (whole encoder counts):
+    x = Component(EpicsSignal, 'TrajX-RB', write_pv='TrajX', tolerance=0.5 / PMAC_MYRES)
+    y = Component(EpicsSignal, 'TrajY-RB', write_pv='TrajY', tolerance=0.5 / PMAC_MYRES)
+    # P1620 and P1621:
+    num_points = Component(EpicsSignal, 'TrajNum-RB', write_pv='TrajNum', tolerance=0)
+    trigger_rate = Component(EpicsSignal, 'TrajRate-RB', write_pv='TrajRate', tolerance=1e-6)
+    start_scan = Component(EpicsSignal, 'StartTraj.PROC')
+    # PLC 18, shared with HXNStage:
+    abort_scan = Component(EpicsSignal, 'AbortScan.PROC')
+
+
+class TrajectoryFlyer(Flyer):
+    """Flyer for the trajectories of HXNTrajectory.
+
+    The events hold the positions of the uploaded table, as quantized to
+    encoder counts by the PMAC, instead of a computed raster.
+    """
+    def _read_trajectory(self):
+        num_points = int(self.hxn_stage.num_points.get())
+        return {'x': np.asarray(self.hxn_stage.x.get(), dtype=float)[:num_points],
+                'y': np.asarray(self.hxn_stage.y.get(), dtype=float)[:num_points]}
+
+    def _num_points(self):
+        return len(self._traj_info['x'])
+
+    def _describe_positions(self):
+        return {axis: {'source': f'{self.hxn_stage.name}_{axis}',
+                       'dtype': 'number',
+                       'shape': []}
+                for axis in ['x', 'y']}
+
+    def _positions(self, start, stop):
+        return self._traj_info['x'][start:stop], self._traj_info['y'][start:stop]
+
+    def _timing(self):
+        timing = prog17_timing(self._traj_info['x'], self._traj_info['y'],
+                               trigger_rate=self.hxn_stage.trigger_rate.get(),
+                               trigger_times=True)
+        # The compare output is high for half of the period:
+        return {'total': timing['total'],
+                'trigger_period': timing['trigger_period'],
+                'pulse_width': timing['trigger_period'] / 2,
+                'trigger_times': timing['trigger_times']}
+
+
+# Objects for the scan
+if SIMULATION:
+    hxn_trajectory = SimHXNTrajectory(name='hxn_trajectory', camera=vis_eye1,
+                                      scan_in_progress=scan_in_progress)
+else:
+    hxn_trajectory = HXNTrajectory('XF:03IDC-CT{MC:01}', name='hxn_trajectory')
+trajectory_flyer = lazy_device(lambda: TrajectoryFlyer(vis_eye1, hxn_trajectory,
+                                                       run_engine=RE))
+
+
+def check_trajectory(x, y, *, exp_time, trigger_rate, readout_time=CAMERA_READOUT_TIME):
+    """Raise ValueError if PROG17 cannot fly the points at ``trigger_rate``.
+
+    Returns the prog17_timing() of the trajectory.
+    """
+    if len(x) != len(y) or not len(x):
+        raise ValueError('x and y must be non-empty and of the same length')
+    if len(x) > PROG17_MAX_POINTS:
+        raise ValueError(f'{len(x)} points do not fit in the PMAC table '
+                         f'(at most {PROG17_MAX_POINTS})')
+    timing = prog17_timing(x, y, trigger_rate=trigger_rate)
+    if timing['trigger_period'] < exp_time + readout_time:
+        raise ValueError(f'trigger_rate={trigger_rate} leaves less than the readout time '
+                         f'of {readout_time} s after each exposure')
+    if timing['max_speed'] > PMAC_MAX_SPEED:
+        raise ValueError(f'trigger_rate={trigger_rate} needs {timing["max_speed"]:.3f} mm/s '
+                         f'(at most {PMAC_MAX_SPEED} mm/s)')
+    return timing
+
+
+def setup_trajectory_scan(x, y, *, exp_time, trigger_rate, num_images=None, timeout=5.0,
+                          upload_timeout=30.0):
+    """Upload the points to HXNTrajectory and program the camera.
+
+    The point tables are written first and confirmed within
+    ``upload_timeout`` seconds; the number of points, the trigger rate and
+    the camera settings are then set and confirmed like in setup_fly_scan.
+    """
+    # The PMAC positions are whole encoder counts:
+    x = np.round(np.asarray(x, dtype=float) * PMAC_MYRES) / PMAC_MYRES
+    y = np.round(np.asarray(y, dtype=float) * PMAC_MYRES) / PMAC_MYRES
+    if len(x) > PROG17_MAX_POINTS:
+        raise ValueError(f'{len(x)} points do not fit in the PMAC table '
+                         f'(at most {PROG17_MAX_POINTS})')
+    if num_images is None:
+        num_images = len(x)
+    trajectory = trajectory_flyer.hxn_stage
+
+    # The readbacks hold the whole tables; the points past the last one
+    # repeat it, PROG17 stops at num_points anyway:
+    table_x = np.pad(x, (0, PROG17_MAX_POINTS - len(x)), mode='edge')
+    table_y = np.pad(y, (0, PROG17_MAX_POINTS - len(y)), mode='edge')
+    yield from _set_and_confirm(trajectory.x, table_x, trajectory.y, table_y,
+                                timeout=upload_timeout)
+
+    setpoints = [trajectory.num_points, len(x),
+                 trajectory.trigger_rate, trigger_rate]
+    setpoints += _camera_setpoints(trajectory_flyer, exp_time=exp_time,
+                                   num_images=num_images)
+    yield from _set_and_confirm(*setpoints, timeout=timeout)
+    print(f'{trajectory.name}: {len(x)} points, trigger_rate={trigger_rate}; '
+          f'exp_time={exp_time}, num_images={num_images}')
+
+
+def fly_trajectory(x, y, *, exp_time, trigger_rate, check=True, gather=None, md=None):
+    """Fly scan along the points ``x``, ``y`` (mm), in this order.
+
+    How to run:
+    -----------
+    x, y = fermat_points(x_center=0, y_center=0, x_range=0.1, y_range=0.1, dr=0.005)
+    RE(fly_trajectory(x, y, exp_time=0.01, trigger_rate=20))
+
+    Parameters
+    ----------
+    x, y : array
+        positions of the stage at every trigger
+    exp_time : float
+        exposure time of the camera
+    trigger_rate : float
+        points per second
+    check : bool, optional
+        refuse a trajectory which the PMAC or the camera cannot follow
+    gather : PMACGather, optional
+        record the measured position and time of every trigger (e.g.
+        hxn_gather, see 23-gather.py)
+    md : dict, optional
+        metadata
+    """
+    if check:
+        timing = check_trajectory(x, y, exp_time=exp_time, trigger_rate=trigger_rate)
+        print(f'Predicted scan time: {timing["total"]:.1f} s')
+    _md = {'plan_name': 'fly_trajectory',
+           'num_points': len(x),
+           'exp_time': exp_time,
+           'trigger_rate': trigger_rate}
+    _md.update(md or {})
+
+    yield from setup_trajectory_scan(x, y, exp_time=exp_time, trigger_rate=trigger_rate)
+
+    @bpp.stage_decorator([trajectory_flyer])
+    def _fly_trajectory():
+        yield from fly_collect(trajectory_flyer, md=_md)
+
+    return (yield from gather_wrapper(_fly_trajectory(), trajectory_flyer, gather))
+
+
+def fly_spiral(*, x_center, y_center, x_range, y_range, dr, nth, dr_y=None, tilt=0.0,
+               exp_time, trigger_rate, md=None):
+    """Fly scan version of the spiral step scan (see spiral_points)."""
+    x, y = spiral_points(x_center=x_center, y_center=y_center, x_range=x_range,
+                         y_range=y_range, dr=dr, nth=nth, dr_y=dr_y, tilt=tilt)
+    _md = {'pattern': 'spiral', 'dr': dr, 'nth': nth}
+    _md.update(md or {})
+    return (yield from fly_trajectory(x, y, exp_time=exp_time,
+                                      trigger_rate=trigger_rate, md=_md))
+
+
+def fly_fermat(*, x_center, y_center, x_range, y_range, dr, factor=1.0, tilt=0.0,
+               exp_time, trigger_rate, md=None):
+    """Fly scan version of the Fermat spiral step scan (see fermat_points)."""
+    x, y = fermat_points(x_center=x_center, y_center=y_center, x_range=x_range,
+                         y_range=y_range, dr=dr, factor=factor, tilt=tilt)
+    _md = {'pattern': 'fermat', 'dr': dr, 'factor': factor}
+    _md.update(md or {})
+    return (yield from fly_trajectory(x, y, exp_time=exp_time,
+                                      trigger_rate=trigger_rate, md=_md))
+
+
+def fly_spiral_square(*, x_center, y_center, x_range, y_range, x_num, y_num,
+                      exp_time, trigger_rate, md=None):
+    """Fly scan version of the square spiral step scan (see spiral_square_points)."""
+    x, y = spiral_square_points(x_center=x_center, y_center=y_center, x_range=x_range,
+                                y_range=y_range, x_num=x_num, y_num=y_num)
+    _md = {'pattern': 'spiral_square', 'x_num': x_num, 'y_num': y_num}
+    _md.update(md or {})
+    return (yield from fly_trajectory(x, y, exp_time=exp_time,
+                                      trigger_rate=trigger_rate, md=_md))
+
+
+startup_timer.mark('22-trajectory.py')
@@ -0,0 +1,101 @@
+# Positions and times of the compare triggers from the PMAC gather buffer
+# (pmc/Gather.pmc), merged into the events of the Flyer.
+from ophyd.status import wait as status_wait
+
+
+def unwrap_counter(values, bits=24):
+    """Undo the rollovers of a ``bits`` wide hardware counter."""
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return values
+    period = 1 << bits
+    steps = (np.diff(values) + period // 2) % period - period // 2
+    return values[0] + np.concatenate([[0], np.cumsum(steps)])
+
+
+def decode_gather(servo, enc1, enc2, status, *, compare_bit=9,
+                  servo_period=PMAC_SERVO_PERIOD):
+    """Return the times (s) and encoder counts of the compare triggers.
+
+    A trigger is a rising edge of the compare output (``compare_bit`` of
+    the ENC1 status word). It happened between the last low and the first
+    high sample, so the time and positions of the two are averaged. Times
+    are relative to the first sample.
+    """
+    servo = unwrap_counter(servo)
+    enc1 = unwrap_counter(enc1)
+    enc2 = unwrap_counter(enc2)
+    high = (np.asarray(status, dtype=np.int64) >> compare_bit) & 1
+    edges = np.flatnonzero(np.diff(high) == 1) + 1
+    t = (servo - servo[0]) * servo_period if len(servo) else servo
+    return {'time': (t[edges - 1] + t[edges]) / 2,
+            'enc1': (enc1[edges - 1] + enc1[edges]) / 2,
+            'enc2': (enc2[edges - 1] + enc2[edges]) / 2}
+
+
+def _put_complete(signal, value, timeout=None):
+    """Put ``value`` and wait until the record has finished processing."""
+    status = DeviceStatus(signal)
+    signal.put(value, use_complete=True,
+               callback=lambda *args, **kwargs: status._finished())
+    status_wait(status, timeout)
+
+
+class PMACGather(Device):
+    """Gather buffer of the PMAC, read back through EPICS waveforms."""
+    period = Component(EpicsSignal, 'Gather:Period-RB', write_pv='Gather:Period')  # I5049
+    capacity = Component(EpicsSignalRO, 'Gather:MaxSamples-RB')
+    num_samples = Component(EpicsSignalRO, 'Gather:NumSamples-RB')
+    start_cmd = Component(EpicsSignal, 'Gather:Start.PROC')    # DEFINE GATHER, GATHER
+    stop_cmd = Component(EpicsSignal, 'Gather:Stop.PROC')      # ENDGATHER
+    upload_cmd = Component(EpicsSignal, 'Gather:Upload.PROC')  # LIST GATHER
+    servo = Component(EpicsSignalRO, 'Gather:Servo-Wfm')
+    enc1 = Component(EpicsSignalRO, 'Gather:Enc1-Wfm')
+    enc2 = Component(EpicsSignalRO, 'Gather:Enc2-Wfm')
+    status = Component(EpicsSignalRO, 'Gather:Status-Wfm')
+
+    def __init__(self, *args, upload_timeout=30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_timeout = upload_timeout
+        self.start_time = None
+
+    def gather_period(self, *, duration, pulse_width):
+        """Return the period (servo cycles) which catches every trigger.
+
+        Every pulse of ``pulse_width`` s is sampled at least twice. None is
+        returned if ``duration`` s of such samples do not fit in the buffer.
+        """
+        cycles = max(1, int(pulse_width / 2 / PMAC_SERVO_PERIOD))
+        needed = 1.1 * duration / (cycles * PMAC_SERVO_PERIOD) + 100
+        if needed > self.capacity.get():
+            return None
+        return cycles
+
+    def start(self, period):
+        _put_complete(self.period, period, self.upload_timeout)
+        _put_complete(self.start_cmd, 1, self.upload_timeout)
+        self.start_time = time.time()
+
+    def finish(self):
+        """Stop gathering and return the raw buffer as NumPy arrays."""
+        _put_complete(self.stop_cmd, 1, self.upload_timeout)
+        _put_complete(self.upload_cmd, 1, self.upload_timeout)
+        num_samples = int(self.num_samples.get())
+        return {name: np.asarray(getattr(self, name).get())[:num_samples]
+                for name in ['servo', 'enc1', 'enc2', 'status']}
+
+
+if SIMULATION:
+    hxn_gather = SimPMACGather(name='hxn_gather')
+    for _program in [hxn_stage, hxn_trajectory]:
+        _program.gather = hxn_gather
+else:
+    hxn_gather = PMACGather('XF:03IDC-CT{MC:01}', name='hxn_gather')
+# The gather needs the Gather:* records of the motion controller IOC, so it
+# is only used when asked for, per scan:
+#     RE(fly_scan(..., gather=hxn_gather))
+# or for every scan with flyer.gather = hxn_gather. Without it the points
+# are published during the flight (see fly_live), with computed positions.
+
+
+startup_timer.mark('23-gather.py')
@@ -0,0 +1,156 @@
+# Dry-run duration estimates of fly_scan, tomo_fly_scan and tomo_scan.
+#
+# The estimate_* functions are the dry runs of the plans: plain functions
+# taking the same parameters, which touch no hardware and return the
+# predicted duration of every phase, e.g.
+#
+#     print_estimate(estimate_tomo_fly_scan(0, 180, 91))
+#
+# The PMAC program time comes from the PROG16 model (06-timing.py); the
+# time spent around it is given by FLY_OVERHEADS. The estimates use the
+# phases of the plan profiler (01-profiler.py), and the plans store them in
+# the run metadata as 'predicted_phases'; once plan_profiler.enable() is
+# called, it prints the achieved against the predicted time of every phase
+# after a real run. Adjust FLY_OVERHEADS when the achieved times drift
+# from the predictions.
+
+# Time spent outside of the PMAC program, in seconds. These are estimates;
+# measure them with plan_profiler for the detectors and IOCs in use.
+FLY_OVERHEADS = {
+    'setup': 0.5,               # _set_and_confirm of the trajectory and the camera
+    'stage': 1.5,               # stage + unstage of the flyer (HDF5 file open/close)
+    'flight': 0.5,              # kickoff until scan_in_progress, frame watchdog
+    'collect_per_point': 2e-4,  # Flyer.collect / collect_asset_docs
+    'insert_per_point': 2e-4,   # document writer (booked as 'insert')
+    'run': 0.2,                 # open_run, close_run, baseline readings
+    'move': 0.2,                # a motor move besides its travel time
+}
+# Motors of the sample, for the rotations and returns of the tomography plans:
+SAMPLE_ROTATION_SPEED = 10.0  # deg/s, sample.sth
+SAMPLE_MOVE_SPEED = 1.0       # mm/s, sample.sx and sample.sy
+SAMPLE_ACCEL_TIME = 0.2       # s
+
+
+def sample_move_time(distance, speed):
+    """Duration of a move of a sample motor, overhead included."""
+    distance = abs(distance)
+    if distance == 0:
+        return FLY_OVERHEADS['move']
+    return FLY_OVERHEADS['move'] + distance / speed + SAMPLE_ACCEL_TIME
+
+
+def estimate_fly_scan(*, x_start, x_stop, nx, y_start, y_stop, ny, exp_time,
+                      trigger_rate=7, snake=False, live=False, stage=True, setup=True):
+    """Predict the duration of fly_scan, per plan profiler phase.
+
+    ``stage`` and ``setup`` leave out the staging and the setup of the
+    camera and trajectory, for scans flown while the flyer stays staged.
+    Returns a dict with the 'trigger_rate', the 'phases' (s), their
+    'total' (s) and the 'program' phases of PROG16 (see prog16_timing).
+    """
+    if trigger_rate == 'max':
+        trigger_rate = plan_fly_scan(x_start=x_start, x_stop=x_stop, nx=nx,
+                                     y_start=y_start, y_stop=y_stop, ny=ny,
+                                     exp_time=exp_time, snake=snake)['settings']['trigger_rate']
+    timing = prog16_timing(x_start=x_start, x_stop=x_stop, nx=nx,
+                           y_start=y_start, y_stop=y_stop, ny=ny,
+                           trigger_rate=trigger_rate, snake=snake)
+    num_points = nx * ny
+    phases = {'setup': FLY_OVERHEADS['setup'] if setup else 0.0,
+              'stage': FLY_OVERHEADS['stage'] if stage else 0.0,
+              'collect': FLY_OVERHEADS['collect_per_point'] * num_points,
+              'insert': FLY_OVERHEADS['insert_per_point'] * num_points,
+              'other': FLY_OVERHEADS['run']}
+    if live:
+        # fly_live polls (sleeps) while the PMAC runs:
+        phases['sleeps'] = timing['total']
+        phases['flight'] = FLY_OVERHEADS['flight']
+    else:
+        phases['flight'] = timing['total'] + FLY_OVERHEADS['flight']
+    return {'trigger_rate': trigger_rate,
+            'phases': phases,
+            'total': sum(phases.values()),
+            'program': timing['phases']}
+
+
+def estimate_tomo_fly_scan(angle_start, angle_end, angle_num, *,
+                           x0=-5.77, y0=-4.6, x_range=1.4, nx=36, y_range=1.0, ny=26,
+                           exp_time=0.1, trigger_rate=9, snake=False,
+                           rotation_speed=SAMPLE_ROTATION_SPEED,
+                           move_speed=SAMPLE_MOVE_SPEED):
+    """Predict the duration of tomo_fly_scan (same parameters).
+
+    The camera and trajectory are set up and the flyer is staged once; the
+    rotation to the next angle overlaps the collection of the previous one.
+    The first rotation, from an unknown position, is not counted. Like
+    estimate_tomo_scan, 'per_angle' holds the 'phases' and 'total' of each
+    angle after the first.
+    """
+    raster = dict(x_start=x0 - x_range / 2, x_stop=x0 + x_range / 2, nx=nx,
+                  y_start=y0 - y_range / 2, y_stop=y0 + y_range / 2, ny=ny,
+                  exp_time=exp_time, trigger_rate=trigger_rate, snake=snake)
+    first = estimate_fly_scan(**raster)
+    angle = estimate_fly_scan(**raster, stage=False, setup=False)
+    step = abs(angle_end - angle_start) / max(angle_num - 1, 1)
+    rotation = sample_move_time(step, rotation_speed)
+    # The rotation is waited for once the points of the angle are collected:
+    rotation_wait = max(0.0, rotation - angle['phases']['collect'] - angle['phases']['insert'])
+    x_end, y_end = raster_positions(**{k: raster[k] for k in
+                                       ['x_start', 'x_stop', 'nx', 'y_start',
+                                        'y_stop', 'ny', 'snake']},
+                                    start=nx * ny - 1)
+    move_home = sample_move_time(np.hypot(x_end[0] - x0, y_end[0] - y0), move_speed)
+    per_angle = dict(angle['phases'])
+    per_angle['setup'] = per_angle.get('setup', 0.0) + rotation_wait
+
+    phases = {phase: first['phases'].get(phase, 0.0) +
+              (angle_num - 1) * angle['phases'].get(phase, 0.0)
+              for phase in set(first['phases']) | set(angle['phases'])}
+    # One run for all angles:
+    phases['other'] = FLY_OVERHEADS['run']
+    phases['setup'] += (angle_num - 1) * rotation_wait + move_home
+    return {'trigger_rate': first['trigger_rate'],
+            'phases': phases,
+            'total': sum(phases.values()),
+            'per_angle': {'phases': per_angle, 'total': sum(per_angle.values())},
+            'program': first['program']}
+
+
+def estimate_tomo_scan(angle_start, angle_end, angle_num,
+                       rotation_speed=SAMPLE_ROTATION_SPEED, move_speed=SAMPLE_MOVE_SPEED):
+    """Predict the duration of tomo_scan: one staged fly_scan per angle.
+
+    Returns the same dict as estimate_fly_scan for the whole series, and
+    the prediction of each angle in 'per_angle' (its 'phases' are what
+    tomo_scan stores in the metadata of each run).
+    """
+    x0, y0, scan = _tomo_scan_raster()
+    fly = estimate_fly_scan(**scan)
+    step = abs(angle_end - angle_start) / max(angle_num - 1, 1)
+    x_end, y_end = raster_positions(**{k: scan[k] for k in
+                                       ['x_start', 'x_stop', 'nx', 'y_start', 'y_stop', 'ny']},
+                                    start=scan['nx'] * scan['ny'] - 1)
+    per_angle = dict(fly['phases'])
+    per_angle['setup'] += (sample_move_time(step, rotation_speed) +
+                           sample_move_time(x_end[0] - x0, move_speed) +
+                           sample_move_time(y_end[0] - y0, move_speed))
+    phases = {phase: angle_num * seconds for phase, seconds in per_angle.items()}
+    return {'trigger_rate': fly['trigger_rate'],
+            'phases': phases,
+            'total': sum(phases.values()),
+            'per_angle': {'phases': per_angle, 'total': sum(per_angle.values())},
+            'program': fly['program']}
+
+
+def print_estimate(estimate, title='Predicted'):
+    """Print the phases and total of an estimate_* result."""
+    phases = estimate['phases']
+    print(f'{title}: {estimate["total"]:.1f} s (trigger_rate={estimate["trigger_rate"]})')
+    for phase in plan_profiler.PHASE_NAMES:
+        if phases.get(phase):
+            print(f'{phase:>16}: {phases[phase]:9.3f}')
+    print('  PMAC program: ' + ', '.join(f'{name} {seconds:.2f}'
+                                          for name, seconds in estimate['program'].items()))
+
+
+startup_timer.mark('24-estimate.py')
@@ -0,0 +1,181 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Per-frame metrics: each one maps a (n, height, width) stack of frames to
+# n numbers.
+
+def frame_total(frames):
+    return frames.sum(axis=(-2, -1), dtype=np.float64)
+
+
+def frame_max(frames):
+    return frames.max(axis=(-2, -1)).astype(np.float64)
+
+
+def _frame_moments(frames, axis):
+    # Profile along one image axis: axis=-1 gives x, axis=-2 gives y.
+    profile = frames.sum(axis=(-2 if axis == -1 else -1), dtype=np.float64)
+    coords = np.arange(profile.shape[-1], dtype=np.float64)
+    total = profile.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (profile * coords).sum(axis=-1) / total
+        var = (profile * (coords - mean[:, None]) ** 2).sum(axis=-1) / total
+    return mean, np.sqrt(var)
+
+
+def frame_centroid_x(frames):
+    return _frame_moments(frames, -1)[0]
+
+
+def frame_centroid_y(frames):
+    return _frame_moments(frames, -2)[0]
+
+
+def frame_sigma_x(frames):
+    return _frame_moments(frames, -1)[1]
+
+
+def frame_sigma_y(frames):
+    return _frame_moments(frames, -2)[1]
+
+
+def _roi_sum(frames, x, y, width, height):
+    return frame_total(frames[:, y:y + height, x:x + width])
+
+
+def roi_sum(x, y, width, height):
+    """Return a metric which sums the region of interest of each frame."""
+    return functools.partial(_roi_sum, x=x, y=y, width=width, height=height)
+
+
+FRAME_METRICS = {'total': frame_total,
+                 'max': frame_max,
+                 'centroid_x': frame_centroid_x,
+                 'centroid_y': frame_centroid_y,
+                 'sigma_x': frame_sigma_x,
+                 'sigma_y': frame_sigma_y,
+                 }
+
+
+def fly_scan_layout(header, stream_name='primary'):
+    """Return the frames handler and the grid of the points of a fly scan.
+
+    The dict holds the 'handler', the 'offset' of the first point in the
+    file, 'ny' and 'nx', the positions 'x' and 'y' as ``(ny, nx)`` arrays in
+    spatial order, and 'flip', the rows acquired in the other direction
+    than the first one (snake scans), whose points are reversed in 'x' and
+    'y'.
+    """
+    handler, offset, ny, nx = fly_scan_handler(header, stream_name)
+    # The table is indexed by seq_num, but its rows are not necessarily in
+    # that order:
+    table = header.table(stream_name=stream_name, fill=False).sort_index()
+    assert len(table) == ny * nx, f'{len(table)} points do not fill a {ny} x {nx} map'
+    x = np.array(table['x'], dtype=float).reshape(ny, nx)
+    y = np.array(table['y'], dtype=float).reshape(ny, nx)
+    direction = np.sign(x[:, -1] - x[:, 0])
+    flip = direction != direction[0] if nx > 1 else np.zeros(ny, dtype=bool)
+    x[flip] = x[flip, ::-1]
+    y[flip] = y[flip, ::-1]
+    return {'handler': handler, 'offset': offset, 'ny': ny, 'nx': nx,
+            'x': x, 'y': y, 'flip': flip}
+
+
+def _reduce_chunk(handler, start, stop, metrics):
+    # Runs in a worker thread; h5py releases the GIL while it reads and
+    # decompresses, and NumPy while it reduces.
+    frames = handler.read_range(start, stop)
+    return start, {name: func(frames) for name, func in metrics.items()}
+
+
+def _reduce_stream(header, stream_name, metrics, chunk_size, pool):
+    layout = fly_scan_layout(header, stream_name)
+    handler, offset, ny, nx = (layout[key] for key in ['handler', 'offset', 'ny', 'nx'])
+    num_points = ny * nx
+    results = {name: np.full(num_points, np.nan) for name in metrics}
+    futures = [pool.submit(_reduce_chunk, handler, offset + start,
+                           offset + min(start + chunk_size, num_points), metrics)
+               for start in range(0, num_points, chunk_size)]
+    for future in futures:
+        start, chunk = future.result()
+        for name, values in chunk.items():
+            results[name][start - offset:start - offset + len(values)] = values
+
+    maps = {name: values.reshape(ny, nx) for name, values in results.items()}
+    for values in maps.values():
+        values[layout['flip']] = values[layout['flip'], ::-1]
+    maps['x'] = layout['x']
+    maps['y'] = layout['y']
+    return handler._filename, maps
+
+
+def reduce_fly_scan(header, metrics=('total', 'centroid_x', 'centroid_y', 'sigma_x', 'sigma_y'),
+                    *, stream_names=None, filename=None, chunk_size=500, workers=None,
+                    background=True):
+    """Compute per-frame metrics of a fly scan into 2D maps.
+
+    The frames are read in chunks of ``chunk_size`` points and reduced by
+    ``workers`` threads (one per core by default). Threads rather than
+    processes: forking this session would copy its CA threads and open
+    HDF5 files into the children. The maps are written to an HDF5 file with
+    one group per stream, holding one ``(ny, nx)`` dataset per metric plus
+    the ``x`` and ``y`` positions of each point, in spatial order (the odd
+    rows of snake scans are reversed).
+
+    How to run:
+    -----------
+    future = reduce_fly_scan(db[-1], ['total', 'centroid_x', roi_sum(100, 100, 50, 50)])
+    future.result()  # the name of the written file
+
+    Parameters
+    ----------
+    header : Header
+        the fly scan (or tomo_fly_scan) run
+    metrics : list or dict, optional
+        names from FRAME_METRICS or callables; a dict maps dataset names to
+        either of them
+    stream_names : list, optional
+        the streams to reduce; by default 'primary' and every 'angle_NNN'
+    filename : str, optional
+        output file; defaults to the first raw file with '_reduced.h5'
+    chunk_size : integer, optional
+        number of points read and reduced at once by a worker
+    workers : integer, optional
+        number of worker threads
+    background : bool, optional
+        run in a background thread and return a Future of the file name
+    """
+    if not isinstance(metrics, dict):
+        metrics = {m if isinstance(m, str) else f'metric{i}': m
+                   for i, m in enumerate(metrics)}
+    metrics = {name: FRAME_METRICS[m] if isinstance(m, str) else m
+               for name, m in metrics.items()}
+    if stream_names is None:
+        stream_names = [s for s in header.stream_names
+                        if s == 'primary' or s.startswith('angle_')]
+
+    def _reduce():
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            maps = {}
+            for stream_name in stream_names:
+                raw_filename, maps[stream_name] = _reduce_stream(
+                    header, stream_name, metrics, chunk_size, pool)
+        out = filename or os.path.splitext(raw_filename)[0] + '_reduced.h5'
+        with h5py.File(out, 'w') as f:
+            f.attrs['run_uid'] = header.start['uid']
+            for stream_name, stream_maps in maps.items():
+                group = f.create_group(stream_name)
+                for name, values in stream_maps.items():
+                    group.create_dataset(name, data=values)
+        return out
+
+    if not background:
+        return _reduce()
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(_reduce)
+    executor.shutdown(wait=False)
+    return future
+
+
+startup_timer.mark('30-reduction.py')
@@ -0,0 +1,340 @@
+# Export of fly scans and tomography series to one analysis-ready file.
+#
+# The frames of every angle are copied from the raw HDF5 files into a
+# NeXus/HDF5 file laid out as (angle, y, x, height, width), in spatial
+# order (the odd rows of snake scans are reversed), next to the measured
+# positions, the angles and per-frame statistics. Reconstructions then
+# read one contiguous array instead of joining events and datums.
+import collections
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from bluesky.callbacks import CallbackBase
+
+
+# Largest chunk of the exported frames; a chunk is part of one row:
+EXPORT_CHUNK_BYTES = 8 * 2 ** 20
+# Codecs compressed in the worker threads and written with
+# write_direct_chunk(); the filter plugins compress inside HDF5 instead.
+EXPORT_DIRECT_CODECS = {'None', 'zlib'}
+
+
+def _stream_angle(header, stream_name):
+    """Return the sample.sth angle of a stream, or NaN if it is unknown."""
+    if stream_name.startswith('angle_') and 'angles' in header.start:
+        return float(header.start['angles'][int(stream_name.split('_', 1)[1])])
+    try:
+        # One fly_scan per angle (tomo_scan):
+        return float(header.table('baseline')['sample_sth'].iloc[0])
+    except (KeyError, IndexError):
+        return np.nan
+
+
+def _export_row(layout, row, metrics, chunk_points, compression, level):
+    """Read one row of frames, compute its statistics and encode its chunks.
+
+    Runs in a worker thread. Returns the row, its statistics, and either
+    the encoded chunks (EXPORT_DIRECT_CODECS) or the frames.
+    """
+    nx = layout['nx']
+    start = layout['offset'] + row * nx
+    frames = layout['handler'].read_range(start, start + nx)
+    if layout['flip'][row]:
+        frames = frames[::-1]
+    stats = {name: func(frames) for name, func in metrics.items()}
+    if compression not in EXPORT_DIRECT_CODECS:
+        return row, stats, frames
+    chunks = []
+    for col in range(0, nx, chunk_points):
+        # HDF5 chunks are always whole, even at the end of a row:
+        block = np.zeros((chunk_points,) + frames.shape[1:], dtype=frames.dtype)
+        block[:min(chunk_points, nx - col)] = frames[col:col + chunk_points]
+        data = block.tobytes()
+        if compression == 'zlib':
+            data = zlib.compress(data, 6 if level is None else level)
+        chunks.append((col, data))
+    return row, stats, chunks
+
+
+def _create_store(f, *, ny, nx, frame_shape, dtype, metrics, compression, level):
+    chunk_points = int(max(1, min(nx, EXPORT_CHUNK_BYTES //
+                                  (np.prod(frame_shape) * np.dtype(dtype).itemsize))))
+    f.attrs['default'] = 'entry'
+    entry = f.create_group('entry')
+    entry.attrs['NX_class'] = 'NXentry'
+    entry.attrs['default'] = 'data'
+    data = entry.create_group('data')
+    data.attrs['NX_class'] = 'NXdata'
+    data.attrs['signal'] = 'data'
+    data.attrs['axes'] = ['angle', 'y', 'x', '.', '.']
+    data.attrs['angle_indices'] = 0
+    data.attrs['y_indices'] = 1
+    data.attrs['x_indices'] = 2
+    data.attrs['num_angles'] = 0  # angles completely written
+    data.create_dataset('data', shape=(0, ny, nx) + frame_shape, dtype=dtype,
+                        maxshape=(None, ny, nx) + frame_shape,
+                        chunks=(1, 1, chunk_points) + frame_shape,
+                        **h5py_compression(compression, level=level))
+    data['data'].attrs['compression'] = compression
+    if level is not None:
+        data['data'].attrs['level'] = level
+    data.create_dataset('angle', shape=(0,), maxshape=(None,), dtype='f8')
+    data['angle'].attrs['units'] = 'deg'
+    for name in ['x_position', 'y_position']:
+        data.create_dataset(name, shape=(0, ny, nx), maxshape=(None, ny, nx), dtype='f8')
+        data[name].attrs['units'] = 'mm'
+    for name in ['run_uid', 'stream_name']:
+        data.create_dataset(name, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+    stats = entry.create_group('stats')
+    stats.attrs['NX_class'] = 'NXcollection'
+    for name in metrics:
+        stats.create_dataset(name, shape=(0, ny, nx), maxshape=(None, ny, nx), dtype='f8',
+                             fillvalue=np.nan)
+
+
+def _angle_datasets(f):
+    """Return the datasets holding one entry per angle."""
+    data = f['entry/data']
+    return ([data[name] for name in ['data', 'angle', 'x_position', 'y_position',
+                                     'run_uid', 'stream_name']] +
+            list(f['entry/stats'].values()))
+
+
+def _complete_angles(f):
+    """Drop the angles of an interrupted export; return the exported streams.
+
+    Only the first ``num_angles`` angles are complete, and of those the
+    ones whose run_uid was written (it is written last).
+    """
+    data = f['entry/data']
+    run_uids = data['run_uid'].asstr()[:int(data.attrs['num_angles'])]
+    num_angles = next((i for i, uid in enumerate(run_uids) if not uid), len(run_uids))
+    for ds in _angle_datasets(f):
+        if ds.shape[0] != num_angles:
+            ds.resize(num_angles, axis=0)
+    data.attrs['num_angles'] = num_angles
+    return set(zip(run_uids[:num_angles], data['stream_name'].asstr()[:num_angles]))
+
+
+def _append_angle(f, header, stream_name, layout, metrics, *, workers, max_pending):
+    data = f['entry/data']
+    frames_ds = data['data']
+    compression = frames_ds.attrs['compression']
+    level = frames_ds.attrs.get('level')
+    index = frames_ds.shape[0]
+    ny, nx = layout['ny'], layout['nx']
+    if frames_ds.shape[1:3] != (ny, nx):
+        raise ValueError(f'{stream_name} of {header.start["uid"]} is {ny} x {nx} points, '
+                         f'the export holds {frames_ds.shape[1]} x {frames_ds.shape[2]}')
+    missing = set(metrics) - set(f['entry/stats'])
+    if missing:
+        raise ValueError(f'The export has no statistics {sorted(missing)}')
+    for ds in _angle_datasets(f):
+        ds.resize(index + 1, axis=0)
+    data['angle'][index] = _stream_angle(header, stream_name)
+    data['x_position'][index] = layout['x']
+    data['y_position'][index] = layout['y']
+    if 'x' not in data:
+        # The grid of the first angle:
+        data.create_dataset('x', data=layout['x'][0])
+        data.create_dataset('y', data=layout['y'][:, 0])
+
+    chunk_points = frames_ds.chunks[2]
+    stats = {name: np.full((ny, nx), np.nan) for name in metrics}
+
+    def write(result):
+        row, row_stats, payload = result
+        for name, values in row_stats.items():
+            stats[name][row] = values
+        if compression in EXPORT_DIRECT_CODECS:
+            for col, chunk in payload:
+                frames_ds.id.write_direct_chunk((index, row, col, 0, 0), chunk)
+        else:
+            frames_ds[index, row] = payload
+
+    # The rows are read, reduced and compressed by the workers, and written
+    # here in order; at most max_pending rows are held in memory.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for row in range(ny):
+            pending.append(pool.submit(_export_row, layout, row, metrics, chunk_points,
+                                       compression, level))
+            if len(pending) >= max_pending:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    for name, values in stats.items():
+        f['entry/stats'][name][index] = values
+    data.attrs['num_angles'] = index + 1
+    # Last, so that an angle is only skipped on reopen once it is complete:
+    data['run_uid'][index] = header.start['uid']
+    data['stream_name'][index] = stream_name
+    f.flush()
+
+
+def export_fly_scans(headers, filename, metrics=('total',), *, stream_names=None,
+                     compression='zlib', level=None, workers=4, max_pending=None,
+                     background=False):
+    """Copy fly scans into one (angle, y, x, height, width) NeXus/HDF5 file.
+
+    Every fly scan stream ('primary' and the 'angle_NNN' streams of
+    tomo_fly_scan by default) becomes one angle. An existing file is
+    appended to, skipping the streams it already holds (the angles left
+    incomplete by an interrupted export are dropped), so a tomography
+    series can be exported angle by angle while it is measured (see
+    FlyScanExporter). All streams must have the same raster.
+
+    The layout of the file is:
+
+    - /entry/data/data: the frames, one chunk per part of a row
+    - /entry/data/angle, x, y: the angles and the grid of the first angle
+    - /entry/data/x_position, y_position: the positions of every point
+    - /entry/data/run_uid, stream_name: where every angle comes from
+    - /entry/stats/<metric>: per-frame statistics (see FRAME_METRICS)
+
+    How to run:
+    -----------
+    export_fly_scans(db[-1], '/DATA/export/tomo.h5')
+    export_fly_scans(db(plan_name='tomo_fly_scan'), '/DATA/export/series.h5',
+                     ['total', 'centroid_x'], compression='None')
+
+    Parameters
+    ----------
+    headers : Header or list of Header
+        the runs to export, in order
+    filename : str
+        the export file, created or appended to
+    metrics : list or dict, optional
+        names from FRAME_METRICS or callables, as for reduce_fly_scan
+    stream_names : list, optional
+        the streams of each run to export
+    compression : str, optional
+        'None', 'zlib' or a codec of h5py_compression; only used when the
+        file is created
+    workers : integer, optional
+        number of threads reading, reducing and compressing rows
+    max_pending : integer, optional
+        number of rows held in memory at most (2 * workers by default)
+    background : bool, optional
+        run in a background thread and return a Future of the file name
+    """
+    if not isinstance(headers, (list, tuple)):
+        headers = [headers] if hasattr(headers, 'start') else list(headers)
+    if not isinstance(metrics, dict):
+        metrics = {m if isinstance(m, str) else f'metric{i}': m
+                   for i, m in enumerate(metrics)}
+    metrics = {name: FRAME_METRICS[m] if isinstance(m, str) else m
+               for name, m in metrics.items()}
+    max_pending = max_pending or 2 * workers
+
+    def _export():
+        with h5py.File(filename, 'a') as f:
+            done = _complete_angles(f) if 'entry' in f else set()
+            for header in headers:
+                names = stream_names or [s for s in header.stream_names
+                                         if s == 'primary' or s.startswith('angle_')]
+                for stream_name in sorted(names):
+                    if (header.start['uid'], stream_name) in done:
+                        continue
+                    layout = fly_scan_layout(header, stream_name)
+                    if 'entry' not in f:
+                        dataset = layout['handler'].dataset
+                        _create_store(f, ny=layout['ny'], nx=layout['nx'],
+                                      frame_shape=dataset.shape[-2:], dtype=dataset.dtype,
+                                      metrics=metrics, compression=compression, level=level)
+                    _append_angle(f, header, stream_name, layout, metrics,
+                                  workers=workers, max_pending=max_pending)
+        return filename
+
+    if not background:
+        return _export()
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(_export)
+    executor.shutdown(wait=False)
+    return future
+
+
+class FlyScanExporter(CallbackBase):
+    """Append every fly scan to an export file as soon as it is finished.
+
+    Subscribed to the RunEngine, it exports the runs one after the other in
+    a background thread (see export_fly_scans), so the series grows angle
+    by angle during a tomo_scan. The flyer is unstaged after the stop
+    document, so the raw file is only read once ``plugin`` has stopped
+    capturing (its file is closed), and only if it captured every frame of
+    the run.
+
+    How to run:
+    -----------
+    exporter = FlyScanExporter('/DATA/export/tomo.h5', ['total'], plugin=vis_eye1.hdf5)
+    token = RE.subscribe(exporter)
+    RE(tomo_scan(0, 180, 91))
+    exporter.wait()
+    """
+    def __init__(self, filename, metrics=('total',), *, plugin, close_timeout=60.0,
+                 **kwargs):
+        super().__init__()
+        self.filename = filename
+        self.metrics = metrics
+        self.plugin = plugin
+        self.close_timeout = close_timeout
+        self.kwargs = kwargs
+        self.futures = []
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def stop(self, doc):
+        if doc.get('exit_status') != 'success':
+            return
+        # Subscribe now, before the unstage: the next run may start a new
+        # capture before the export thread gets to look at the plugin.
+        closed = threading.Event()
+        captured = {}
+
+        def on_num_captured(value, **kwargs):
+            if not closed.is_set():
+                captured['latest'] = value
+
+        def on_capture(value, **kwargs):
+            if value == 0 and not closed.is_set():
+                captured['final'] = captured.get('latest')
+                closed.set()
+
+        subscriptions = [(self.plugin.num_captured,
+                          self.plugin.num_captured.subscribe(on_num_captured)),
+                         (self.plugin.capture, self.plugin.capture.subscribe(on_capture))]
+        self.futures.append(self._executor.submit(self._export, doc['run_start'],
+                                                  closed, captured, subscriptions))
+
+    def _export(self, uid, closed, captured, subscriptions):
+        try:
+            if not closed.wait(self.close_timeout):
+                raise TimeoutError(f'{self.plugin.name} still captures '
+                                   f'{self.close_timeout} s after the end of run {uid}')
+        finally:
+            for signal, cid in subscriptions:
+                signal.unsubscribe(cid)
+        # The document writer has inserted the run before the stop document
+        # returned (see BufferedDocumentWriter).
+        header = db[uid]
+        stream_names = [s for s in header.stream_names
+                        if s == 'primary' or s.startswith('angle_')]
+        if not stream_names:
+            return None
+        num_frames = 0
+        for stream_name in stream_names:
+            handler, offset, ny, nx = fly_scan_handler(header, stream_name)
+            num_frames = max(num_frames, (offset + ny * nx) * handler._frame_per_point)
+        if captured.get('final') is not None and captured['final'] < num_frames:
+            raise RuntimeError(f'{self.plugin.name} captured {captured["final"]} of the '
+                               f'{num_frames} frames of run {uid}')
+        return export_fly_scans(header, self.filename, self.metrics, **self.kwargs)
+
+    def wait(self):
+        """Wait for the queued exports; raise the first error."""
+        for future in self.futures:
+            future.result()
+        self.futures.clear()
+
+
+startup_timer.mark('31-export.py')
@@ -0,0 +1,238 @@
+# Live 2D maps of the camera statistics during fly scans.
+#
+# The BestEffortCallback plots are disabled (00-startup.py) and the points
+# of a fly scan are only published after complete(), so LiveFlyMap follows
+# the frames through monitors of the stats plugins instead. Every update only
+# writes one pixel of a preallocated image; the figure is redrawn by a GUI
+# timer at most ``max_fps`` times per second, so the RunEngine never waits
+# for matplotlib however fast the camera is triggered.
+import math
+
+from bluesky.callbacks import CallbackBase
+from ophyd import Device, Kind
+
+
+def hinted_stats_signals(detector):
+    """Return the hinted signals of the stats plugins of ``detector``."""
+    signals = []
+    for name in detector.component_names:
+        if not name.startswith('stats'):
+            continue
+        plugin = getattr(detector, name)
+        for attr in plugin.component_names:
+            signal = getattr(plugin, attr)
+            if not isinstance(signal, Device) and (signal.kind & Kind.hinted) == Kind.hinted:
+                signals.append(signal)
+    return signals
+
+
+class LiveFlyMap(CallbackBase):
+    """Map of the hinted statistics of ``detector`` over the points of the flyers.
+
+    Every value is placed by the unique id of the frame it was computed
+    from, counted from the camera's array counter at the kickoff (the
+    counter is reset on stage), so frames dropped by a plugin leave holes
+    instead of shifting the map.
+
+    Parameters
+    ----------
+    detector : Device
+        camera whose hinted stats plugin fields (e.g. stats1.total, see
+        configure_camera) are mapped, one image each; their names are also
+        the event keys mapped in step scans with a 'shape' (e.g. grid_scan)
+    flyers : list of Flyer
+        flyers whose kickoffs start a new map
+    max_fps : float, optional
+        maximum number of redraws per second
+    max_pixels : int, optional
+        larger maps are decimated for display (every n-th row and column)
+    """
+    def __init__(self, detector, *, flyers=(), max_fps=4.0, max_pixels=250_000):
+        super().__init__()
+        self.detector = detector
+        self.signals = hinted_stats_signals(detector)
+        # The unique id of the frame processed by each plugin:
+        self.unique_ids = {signal.parent.name: signal.parent.unique_id
+                           for signal in self.signals}
+        self.flyers = list(flyers)
+        self.max_fps = max_fps
+        self.max_pixels = max_pixels
+        self.fields = [signal.name for signal in self.signals]
+        self.images = {}
+        self._pixels = None  # flat pixel of every point, in acquisition order
+        self._extent = None
+        self._unique_id0 = 0
+        self._unique_id_value = {}
+        self._dirty = False
+        self._reset = False
+        self._monitoring = False
+        self._token = None
+        self._figure = None
+        self._axes = {}
+        self._artists = {}
+        self._timer = None
+
+    def enable(self, RE=RE):
+        if self._token is None:
+            self._token = RE.subscribe(self)
+        for flyer in self.flyers:
+            if self._on_kickoff not in flyer.kickoff_callbacks:
+                flyer.kickoff_callbacks.append(self._on_kickoff)
+
+    def disable(self, RE=RE):
+        if self._token is not None:
+            RE.unsubscribe(self._token)
+            self._token = None
+        for flyer in self.flyers:
+            if self._on_kickoff in flyer.kickoff_callbacks:
+                flyer.kickoff_callbacks.remove(self._on_kickoff)
+        self._unmonitor()
+
+    # Allocation of the images
+
+    def _allocate(self, shape, pixels, extent):
+        self.images = {field: np.full(shape, np.nan) for field in self.fields}
+        self._pixels = pixels
+        self._extent = extent
+        self._reset = True
+        self._dirty = True
+
+    def _on_kickoff(self, flyer):
+        """Start a new map over the points of the trajectory being flown."""
+        info = flyer._traj_info
+        x, y = flyer._positions(0, flyer._num_points())
+        if 'nx' in info:
+            nx, ny = info['nx'], info['ny']
+            x0, x1 = sorted([info['x_start'], info['x_stop']])
+            y0, y1 = sorted([info['y_start'], info['y_stop']])
+        else:
+            # Arbitrary trajectories are binned on a square grid with about
+            # one point per pixel:
+            nx = ny = max(1, math.ceil(math.sqrt(len(x))))
+            x0, x1 = float(np.min(x)), float(np.max(x))
+            y0, y1 = float(np.min(y)), float(np.max(y))
+        col = np.rint((x - x0) / ((x1 - x0) or 1) * (nx - 1)).astype(int)
+        row = np.rint((y - y0) / ((y1 - y0) or 1) * (ny - 1)).astype(int)
+        self._allocate((ny, nx), row * nx + col, (x0, x1, y0, y1))
+        self._unique_id0 = self.detector.cam.array_counter.get()
+        self._unique_id_value = {name: self._unique_id0 for name in self.unique_ids}
+        self._monitor()
+        self._show()
+
+    def start(self, doc):
+        # Step scans over a grid (grid_scan and friends); the maps of fly
+        # scans are started by the kickoffs.
+        self._pixels = None
+        shape = doc.get('shape')
+        if shape is not None and len(shape) == 2:
+            ny, nx = shape
+            row, col = np.divmod(np.arange(ny * nx), nx)
+            snaking = doc.get('snaking') or [False, False]
+            if len(snaking) > 1 and snaking[1]:
+                odd = row % 2 == 1
+                col[odd] = nx - 1 - col[odd]
+            self._allocate((ny, nx), row * nx + col, None)
+            self._show()
+
+    def event(self, doc):
+        self._put_points([doc['seq_num']], {field: [doc['data'][field]]
+                                            for field in self.fields if field in doc['data']})
+
+    def event_page(self, doc):
+        self._put_points(doc['seq_num'], {field: doc['data'][field]
+                                          for field in self.fields if field in doc['data']})
+
+    def stop(self, doc):
+        self._unmonitor()
+        self._redraw()
+        if self._timer is not None:
+            self._timer.stop()
+
+    def _put_points(self, seq_nums, data):
+        if self._pixels is None or not data:
+            return
+        index = np.asarray(seq_nums) - 1
+        inside = (index >= 0) & (index < len(self._pixels))
+        for field, values in data.items():
+            self.images[field].flat[self._pixels[index[inside]]] = np.asarray(values)[inside]
+        self._dirty = True
+
+    # Monitors of the plugins (called in the threads of the control layer)
+
+    def _monitor(self):
+        if self._monitoring:
+            return
+        for unique_id in self.unique_ids.values():
+            unique_id.subscribe(self._on_unique_id, run=False)
+        for signal in self.signals:
+            signal.subscribe(self._on_value, run=False)
+        self._monitoring = True
+
+    def _unmonitor(self):
+        if not self._monitoring:
+            return
+        for unique_id in self.unique_ids.values():
+            unique_id.clear_sub(self._on_unique_id)
+        for signal in self.signals:
+            signal.clear_sub(self._on_value)
+        self._monitoring = False
+
+    def _on_unique_id(self, value, obj, **kwargs):
+        self._unique_id_value[obj.parent.name] = value
+
+    def _on_value(self, value, obj, **kwargs):
+        # The plugin posts the unique id of a frame before its statistics,
+        # so the last unique id tells which point this value belongs to.
+        index = self._unique_id_value[obj.parent.name] - self._unique_id0 - 1
+        image = self.images.get(obj.name)
+        if image is None or self._pixels is None or not 0 <= index < len(self._pixels):
+            return
+        image.flat[self._pixels[index]] = value
+        self._dirty = True
+
+    # Drawing (only in the GUI thread)
+
+    def _show(self):
+        if self._figure is None or not plt.fignum_exists(self._figure.number):
+            self._figure, axes = plt.subplots(1, len(self.fields), squeeze=False,
+                                              num='LiveFlyMap')
+            self._axes = dict(zip(self.fields, axes[0]))
+            self._artists = {}
+            self._timer = self._figure.canvas.new_timer(interval=int(1000 / self.max_fps))
+            self._timer.add_callback(self._redraw)
+            self._reset = True
+        self._timer.start()
+
+    def _decimation(self):
+        image = next(iter(self.images.values()))
+        return max(1, math.ceil(math.sqrt(image.size / self.max_pixels)))
+
+    def _redraw(self):
+        if not self._dirty or self._figure is None or not self.images:
+            return
+        self._dirty = False
+        step = self._decimation()
+        for field, image in self.images.items():
+            view = image[::step, ::step]
+            if self._reset or field not in self._artists:
+                ax = self._axes[field]
+                ax.clear()
+                ax.set_title(field if step == 1 else f'{field} (1/{step})')
+                self._artists[field] = ax.imshow(view, origin='lower', aspect='auto',
+                                                 interpolation='nearest',
+                                                 extent=self._extent)
+            else:
+                self._artists[field].set_data(view)
+            if np.isfinite(view).any():
+                self._artists[field].set_clim(np.nanmin(view), np.nanmax(view))
+        self._reset = False
+        self._figure.canvas.draw_idle()
+
+
+live_map = lazy_device(lambda: LiveFlyMap(vis_eye1, flyers=[flyer, trajectory_flyer]))
+# Disable with live_map.disable(). In a lazy startup the map is enabled
+# when the flyer is first used:
+on_first_use(flyer, lambda flyer: live_map.enable())
+
+
+startup_timer.mark('40-livemap.py')
@@ -101,3 +101,6 @@ def step_scan(*, cam,
 
     yield from bpp.finalize_wrapper(main(), move_home())
 '''
+
+
+startup_timer.mark('90-plans.py')
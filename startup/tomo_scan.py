@@ -1,16 +1,107 @@
-def tomo_scan(angle_start,angle_end,angle_num):
+def _tomo_scan_raster():
+    """Return the center and the fly_scan parameters of tomo_scan."""
     x0 = -5.77
     y0 = -4.6
+    return x0, y0, dict(x_start=x0-0.7, x_stop=x0+0.7, nx=36, y_start=y0-0.5, y_stop=y0+0.5, ny=26, exp_time=0.1, trigger_rate=9)
+
+
+def tomo_scan(angle_start,angle_end,angle_num):
+    # Dry run: print_estimate(estimate_tomo_scan(angle_start, angle_end, angle_num))
+    x0, y0, scan = _tomo_scan_raster()
+    estimate = estimate_tomo_scan(angle_start, angle_end, angle_num)
     angle_list = np.linspace(angle_start,angle_end,angle_num)
     print(angle_list)
     #'''
     for i in range(angle_num):
         print('taking data at ', angle_list[i],' deg')
         yield from bps.mov(sample.sth,angle_list[i])
-        yield from fly_scan(x_start=x0-0.7, x_stop=x0+0.7, nx=36, y_start=y0-0.5, y_stop=y0+0.5, ny=26, exp_time=0.1, trigger_rate=9)
+        yield from fly_scan(**scan, md={'predicted_phases': estimate['per_angle']['phases']})
         yield from bps.mov(sample.sx, x0)
         yield from bps.mov(sample.sy, y0)
     #'''
         
 
         
+def tomo_fly_scan(angle_start, angle_end, angle_num, *,
+                  x0=-5.77, y0=-4.6, x_range=1.4, nx=36, y_range=1.0, ny=26,
+                  exp_time=0.1, trigger_rate=9, snake=False, md=None):
+    """Tomography fly scan with all angles in one run and one file.
+
+    The HXNStage and the camera are set up once, and the flyer stays staged
+    (camera armed, HDF5 file open) for the whole series. Each angle is
+    flown as a sub-scan and its points go to the stream ``angle_NNN``.
+    The rotation to the next angle runs while the documents of the
+    previous angle are collected.
+
+    How to run:
+    -----------
+    RE(tomo_fly_scan(0, 180, 91))
+
+    The predicted duration of every phase is printed, without touching the
+    hardware, by
+    print_estimate(estimate_tomo_fly_scan(0, 180, 91))
+
+    Parameters
+    ----------
+    angle_start, angle_end : float
+        first and last angle of sample.sth
+    angle_num : integer
+        number of angles
+    x0, y0 : float
+        center of the field
+    x_range, y_range : float
+        full width and height of the field
+    nx, ny : integer
+        number of points in X and Y
+    exp_time : float
+        exposure time of the camera
+    trigger_rate : integer, optional
+        trigger rate of the camera
+    snake : bool, optional
+        scan alternate rows in the opposite X direction
+    md : dict, optional
+        metadata
+    """
+    estimate = estimate_tomo_fly_scan(angle_start, angle_end, angle_num, x0=x0, y0=y0,
+                                      x_range=x_range, nx=nx, y_range=y_range, ny=ny,
+                                      exp_time=exp_time, trigger_rate=trigger_rate,
+                                      snake=snake)
+    print(f'Predicted scan time: {estimate["total"]:.1f} s '
+          f'({estimate["per_angle"]["total"]:.1f} s per angle)')
+    angle_list = np.linspace(angle_start, angle_end, angle_num)
+    _md = {'plan_name': 'tomo_fly_scan',
+           'angles': list(angle_list),
+           'streams': [f'angle_{i:03d}' for i in range(angle_num)],
+           'predicted_phases': estimate['phases']}
+    _md.update(md or {})
+
+    yield from setup_fly_scan(x_start=x0 - x_range / 2, x_stop=x0 + x_range / 2, nx=nx,
+                              y_start=y0 - y_range / 2, y_stop=y0 + y_range / 2, ny=ny,
+                              exp_time=exp_time, trigger_rate=trigger_rate,
+                              snake=snake, num_images=nx * ny * angle_num)
+
+    def move_home():
+        flyer.stream_name = 'primary'
+        yield from bps.mov(sample.sx, x0, sample.sy, y0)
+
+    @bpp.stage_decorator([flyer])
+    @bpp.run_decorator(md=_md)
+    def _tomo_fly_scan():
+        yield from bps.mov(sample.sth, angle_list[0])
+        for i, angle in enumerate(angle_list):
+            # A frame watchdog pause (Flyer.on_mismatch='pause') stops here.
+            yield from bps.checkpoint()
+            print('taking data at ', angle, ' deg')
+            angle_flyer = flyer.stream(f'angle_{i:03d}')
+            yield from bps.kickoff(angle_flyer, wait=True)
+            yield from bps.complete(angle_flyer, wait=True)
+            if i + 1 < angle_num:
+                # Rotate while the previous angle is collected:
+                yield from bps.abs_set(sample.sth, angle_list[i + 1], group='tomo_rotate')
+            yield from bps.collect(angle_flyer)
+            yield from bps.wait(group='tomo_rotate')
+
+    yield from bpp.finalize_wrapper(_tomo_fly_scan(), move_home())
+
+
+startup_timer.mark('tomo_scan.py')